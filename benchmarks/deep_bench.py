@@ -0,0 +1,73 @@
+# -*- coding: utf-8; -*-
+
+"""
+Measures per-node cost of :func:`testmania.deep.assert_deep_equal` on
+structures of the same size but of different nesting depth, and cost
+of a call of a checker made by :func:`testmania.deep.compile` against
+the interpreted comparison.
+
+Run from the repository root::
+
+    python benchmarks/deep_bench.py
+
+Cost per node is expected to stay flat as depth grows.
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from testmania.deep import assert_deep_equal, compile as compile_expected
+
+from generators import make_comb
+
+
+NODES = 100000
+
+
+def bench(depth, repeat=3):
+    actual = make_comb(NODES, depth)
+    expected = make_comb(NODES, depth)
+    timer = timeit.Timer(lambda: assert_deep_equal(actual, expected))
+    return min(timer.repeat(repeat=repeat, number=1))
+
+
+def make_response(seed):
+    """Typical API response of few dozens of nodes"""
+    return {
+        'id': seed,
+        'status': 'ok',
+        'user': {'name': 'John', 'email': 'john@example.com', 'roles': ['admin', 'dev']},
+        'items': [{'sku': 'sku-%s' % i, 'qty': i, 'price': i * 1.5} for i in xrange(5)],
+        'meta': {'page': 1, 'total': 5, 'next': None},
+    }
+
+
+def bench_compiled(calls=10000, repeat=3):
+    expected = make_response(1)
+    actual = make_response(1)
+    check = compile_expected(expected)
+    interpreted = min(timeit.Timer(lambda: assert_deep_equal(actual, expected))
+                      .repeat(repeat=repeat, number=calls))
+    compiled = min(timeit.Timer(lambda: check(actual))
+                   .repeat(repeat=repeat, number=calls))
+    return interpreted / calls, compiled / calls
+
+
+def main():
+    print '%8s %12s %14s' % ('depth', 'total, s', 'per node, us')
+    for depth in (1, 10, 100, 1000, 10000):
+        elapsed = bench(depth)
+        print '%8s %12.4f %14.3f' % (depth, elapsed, elapsed / NODES * 1e6)
+
+    print
+    interpreted, compiled = bench_compiled()
+    print '%12s %14s' % ('', 'per call, us')
+    print '%12s %14.1f' % ('interpreted', interpreted * 1e6)
+    print '%12s %14.1f' % ('compiled', compiled * 1e6)
+
+
+if __name__ == '__main__':
+    main()
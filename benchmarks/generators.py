@@ -0,0 +1,90 @@
+# -*- coding: utf-8; -*-
+
+"""
+Synthetic inputs for benchmarks.
+
+Every generator builds a structure or a document of about `size` nodes
+whose very last leaf in document order is `tail`. Two calls with the same
+arguments give equal but distinct objects, and calls that differ only in
+`tail` give inputs that differ at the deepest, latest visited point, so
+that a failing comparison has to walk everything first.
+"""
+
+
+def make_wide(size, tail=0):
+    """A flat dict of `size` scalar values"""
+    root = dict(('key%06d' % i, i) for i in xrange(size - 1))
+    root['key%06d' % (size - 1)] = tail
+    return root
+
+
+def make_comb(size, depth, tail=0):
+    """A dict of ``size / depth`` chains each nested `depth` levels"""
+    root = {}
+    count = max(1, size // depth)
+    for i in xrange(count):
+        chain = tail if i == count - 1 else i
+        for level in xrange(depth - 1):
+            chain = {'n%s' % level: chain}
+        root['c%06d' % i] = chain
+    return root
+
+
+def make_deep(size, tail=0):
+    """Chains nested 50 levels deep"""
+    return make_comb(size, 50, tail)
+
+
+def make_lists(size, tail=0):
+    """A list of records, each holding a short list, like a page of an API
+    response"""
+    count = max(1, size // 10)
+    records = [{
+        'id': i,
+        'name': 'item %s' % i,
+        'tags': ['a', 'b', 'c'],
+        'scores': [i, i * 2, i * 3],
+    } for i in xrange(count)]
+    records[-1]['scores'][-1] = tail
+    return records
+
+
+def make_xml_wide(size, tail=0):
+    """A root element with `size` children of distinct tag names"""
+    children = ''.join('<e%06d a="%s">%s</e%06d>' % (i, i, i, i) for i in xrange(size - 1))
+    return '<root>%s<e%06d>%s</e%06d></root>' % (children, size - 1, tail, size - 1)
+
+
+def make_xml_deep(size, tail=0):
+    """Chains of elements nested 50 levels deep, as `make_deep` does"""
+    depth = 50
+    count = max(1, size // depth)
+    chains = []
+    for i in xrange(count):
+        text = tail if i == count - 1 else i
+        chains.append('<n>' * (depth - 1) + str(text) + '</n>' * (depth - 1))
+    return '<root>%s</root>' % ''.join(chains)
+
+
+def make_xml_lists(size, tail=0):
+    """A root element with recurring ``<item>`` elements, each holding
+    few fields"""
+    count = max(1, size // 4)
+    items = ['<item id="%s"><name>item %s</name><qty>%s</qty></item>' % (i, i, i)
+             for i in xrange(count - 1)]
+    items.append('<item id="%s"><name>item %s</name><qty>%s</qty></item>' %
+                 (count - 1, count - 1, tail))
+    return '<root>%s</root>' % ''.join(items)
+
+
+DEEP_SHAPES = {
+    'wide': make_wide,
+    'deep': make_deep,
+    'lists': make_lists,
+}
+
+XML_SHAPES = {
+    'wide': make_xml_wide,
+    'deep': make_xml_deep,
+    'lists': make_xml_lists,
+}
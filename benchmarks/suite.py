@@ -0,0 +1,179 @@
+# -*- coding: utf-8; -*-
+
+"""
+Benchmark suite of :func:`testmania.deep.assert_deep_equal` and
+:func:`testmania.xml.assert_xml_equal`.
+
+Every comparator is run on wide, deep and list-heavy inputs from
+:mod:`generators`, on equal inputs and on inputs differing at the very last
+leaf, with every combination of its options. Run from the repository root
+and save results::
+
+    python benchmarks/suite.py -o before.json
+
+then, after a change::
+
+    python benchmarks/suite.py -o after.json
+    python benchmarks/suite.py --compare before.json after.json
+
+Comparison lists cases that got slower or faster by more than the threshold
+and exits with non-zero status if any got slower. Use ``-k`` to run only
+cases whose names contain a substring.
+"""
+
+import datetime
+import itertools
+import json
+import optparse
+import os
+import platform
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from testmania.deep import assert_deep_equal
+from testmania.xml import assert_xml_equal
+
+from generators import DEEP_SHAPES, XML_SHAPES
+
+
+DEEP_OPTIONS = [
+    ('ignore_extra_keys', (False, True)),
+    ('ignore_list_order', (False, True)),
+    ('max_diffs', (1, 100)),
+]
+
+XML_OPTIONS = [
+    ('ignore_whitespace', (True, False)),
+    ('ignore_extra_elements', (False, True)),
+    ('ignore_element_order', (False, True)),
+    ('ignore_list_order', (False, True)),
+    ('ignore_extra_attrs', (False, True)),
+]
+
+COMPARATORS = [
+    # name, function, shapes, options, default size
+    ('deep', assert_deep_equal, DEEP_SHAPES, DEEP_OPTIONS, 20000),
+    ('xml', assert_xml_equal, XML_SHAPES, XML_OPTIONS, 2000),
+]
+
+
+def option_combinations(options):
+    names = [name for name, _ in options]
+    for values in itertools.product(*[values for _, values in options]):
+        yield dict(zip(names, values))
+
+
+def case_name(comparator, shape, outcome, options):
+    return '%s/%s/%s/%s' % (comparator, shape, outcome, ','.join(
+        '%s=%s' % (name, int(value) if isinstance(value, bool) else value)
+        for name, value in sorted(options.iteritems())))
+
+
+def cases(scale=1.0, pattern=None):
+    """Yield (name, function, actual, expected, options, should fail) tuples"""
+    for comparator, function, shapes, options, size in COMPARATORS:
+        size = max(1, int(size * scale))
+        for shape, generator in sorted(shapes.iteritems()):
+            inputs = {
+                'pass': (generator(size), generator(size)),
+                'fail': (generator(size, tail=-1), generator(size)),
+            }
+            for outcome in ('pass', 'fail'):
+                actual, expected = inputs[outcome]
+                for combination in option_combinations(options):
+                    name = case_name(comparator, shape, outcome, combination)
+                    if pattern and pattern not in name:
+                        continue
+                    yield name, function, actual, expected, combination, outcome == 'fail'
+
+
+def measure(function, actual, expected, options, should_fail, repeat):
+    def call():
+        try:
+            function(actual, expected, **options)
+        except AssertionError:
+            if not should_fail:
+                raise
+        else:
+            if should_fail:
+                raise AssertionError("Comparison was expected to fail")
+    return min(timeit.Timer(call).repeat(repeat=repeat, number=1))
+
+
+def run(scale, repeat, pattern, output):
+    results = {}
+    for name, function, actual, expected, options, should_fail in cases(scale, pattern):
+        elapsed = measure(function, actual, expected, options, should_fail, repeat)
+        results[name] = elapsed
+        print '%10.4f  %s' % (elapsed, name)
+        sys.stdout.flush()
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'date': datetime.datetime.now().isoformat(),
+                'scale': scale,
+                'repeat': repeat,
+                'results': results,
+            }, f, indent=1, sort_keys=True)
+
+
+def compare(before_path, after_path, threshold):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    if before['scale'] != after['scale']:
+        print 'Warning: runs have different scales, %s and %s' % (before['scale'], after['scale'])
+
+    slower = 0
+    print '%10s %10s %8s' % ('before', 'after', 'ratio')
+    for name in sorted(set(before['results']) & set(after['results'])):
+        old = before['results'][name]
+        new = after['results'][name]
+        ratio = new / old if old else float('inf')
+        if ratio > 1 + threshold:
+            mark = 'slower'
+            slower += 1
+        elif ratio < 1 / (1 + threshold):
+            mark = 'faster'
+        else:
+            continue
+        print '%10.4f %10.4f %7.2fx  %s  %s' % (old, new, ratio, mark, name)
+
+    for name in sorted(set(before['results']) ^ set(after['results'])):
+        print 'Only in %s: %s' % ('before' if name in before['results'] else 'after', name)
+    return slower
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-o FILE] [-k PATTERN] | --compare BEFORE AFTER')
+    parser.add_option('-o', '--output', help="save results to a JSON file")
+    parser.add_option('-k', dest='pattern', help="run only cases whose names contain PATTERN")
+    parser.add_option('-s', '--scale', type=float, default=1.0,
+                      help="multiply default input sizes by SCALE [%default]")
+    parser.add_option('-r', '--repeat', type=int, default=3,
+                      help="take the best of REPEAT runs of each case [%default]")
+    parser.add_option('--compare', action='store_true',
+                      help="compare two saved runs instead of running benchmarks")
+    parser.add_option('-t', '--threshold', type=float, default=0.1,
+                      help="relative change of time to report when comparing [%default]")
+    options, args = parser.parse_args()
+
+    if options.compare:
+        if len(args) != 2:
+            parser.error("--compare needs two result files")
+        if compare(args[0], args[1], options.threshold):
+            sys.exit(1)
+    else:
+        if args:
+            parser.error("unexpected arguments %s" % ' '.join(args))
+        run(options.scale, options.repeat, options.pattern, options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8; -*-
+
+"""
+Counts node pairs allocated by :class:`testmania.xml.Twinode` walk of
+:func:`testmania.xml.assert_xml_equal` while comparing wide documents, along
+with time of the walk, when documents are equal and when they differ at the
+first, the middle or the last child of the root. Documents are parsed
+beforehand and the walk is run directly, since `assert_xml_equal` returns
+early for documents with equal canonical hashes.
+
+Run from the repository root::
+
+    python benchmarks/xml_alloc_bench.py
+
+Once a difference is found no more pairs should be allocated, so a
+difference at the first child should cost few pairs whatever the width is.
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from testmania import xml as testmania_xml
+
+
+WIDTH = 20000
+
+
+def make_document(width, changed=None):
+    items = ['<item id="%s"><name>item %s</name><qty>%s</qty></item>' %
+             (i, i, -1 if i == changed else i) for i in xrange(width)]
+    return '<root>%s</root>' % ''.join(items)
+
+
+class PairCounter(object):
+    """Counts instances of `Twinode` created while installed"""
+
+    def __init__(self):
+        self.count = 0
+        self.original = testmania_xml.Twinode
+
+    def __enter__(self):
+        counter = self
+        original = self.original
+
+        def counting(*args, **kwargs):
+            counter.count += 1
+            return original(*args, **kwargs)
+        # Twinode creates children through the module global
+        testmania_xml.Twinode = counting
+        return self
+
+    def __exit__(self, *exc_info):
+        testmania_xml.Twinode = self.original
+
+
+def compare(actual, expected, ignore_list_order=False, ignore_extra_attrs=False):
+    settings = testmania_xml._settings(False, False, ignore_list_order, ignore_extra_attrs,
+                                       ignore_whitespace=True)
+    testmania_xml.Twinode(actual, expected, settings).probe()
+
+
+def bench(actual, expected, repeat=3, **options):
+    with PairCounter() as counter:
+        compare(actual, expected, **options)
+    elapsed = min(timeit.Timer(lambda: compare(actual, expected, **options))
+                  .repeat(repeat=repeat, number=1))
+    return counter.count, elapsed
+
+
+def main():
+    expected = testmania_xml._load(make_document(WIDTH), True)
+    print '%-28s %10s %10s' % ('case', 'pairs', 'time, s')
+    for name, changed in [('equal', None), ('first child differs', 0),
+                          ('middle child differs', WIDTH // 2),
+                          ('last child differs', WIDTH - 1)]:
+        actual = testmania_xml._load(make_document(WIDTH, changed), True)
+        for options in [{}, {'ignore_list_order': True, 'ignore_extra_attrs': True}]:
+            label = name + (' *' if options else '')
+            pairs, elapsed = bench(actual, expected, **options)
+            print '%-28s %10s %10.4f' % (label, pairs, elapsed)
+    print
+    print '* with ignore_list_order and ignore_extra_attrs'
+
+
+if __name__ == '__main__':
+    main()
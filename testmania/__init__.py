@@ -1,6 +1,7 @@
 
 from testmania.pep8 import *
-from testmania.deep import assert_deep_equal
-from testmania.xml import assert_xml_equal
+from testmania.deep import assert_deep_equal, Fingerprint
+from testmania.json import assert_json_equal
+from testmania.xml import assert_xml_equal, assert_xml_stream_equal
 from testmania.time import assert_just_now
 from testmania.expect import Expectation
@@ -1,12 +1,31 @@
 # -*- coding: utf-8; -*-
 
+import binascii
+import collections
+import hashlib
+import inspect
+import itertools
 import pprint
+import types
 
 from UserDict import UserDict
 from UserList import UserList
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-def assert_deep_equal(actual, expected, msg=None, ignore_extra_keys=False):
+from testmania import instrument
+
+
+# compile is left out not to shadow the builtin on star imports
+__all__ = ['assert_deep_equal', 'Fingerprint']
+
+
+@instrument.instrumented('assert_deep_equal')
+def assert_deep_equal(actual, expected, msg=None, ignore_extra_keys=False, max_diffs=1,
+                      max_message_size=4096, rtol=None, atol=None, ignore_list_order=False):
     """Test for equality two deeply nested data structures of simple 
     types like dicts or lists.
 
@@ -59,22 +78,562 @@ def assert_deep_equal(actual, expected, msg=None, ignore_extra_keys=False):
     corresponding dicts in `expected` at any level, e.g. to have extra keys. This is
     handy in cases when it is important to test whether at least necessary items
     are present in a data structure.
+
+    Structures may share subtrees or contain reference cycles. A pair of
+    objects which is the very same object is considered equal without
+    looking inside, and a pair of containers met again is compared only once.
+
+    By default comparison stops at the first difference found. Pass `max_diffs`
+    greater than 1 to continue looking for more differences in the same run.
+    At most `max_diffs` of them are reported, each with its own path, and the
+    traversal stops as soon as that many are found.
+
+    Structures are printed in the failure message in full only if they are
+    small. Otherwise just a window around the (first) difference is printed:
+    its ancestors, few siblings on every level and shortened values. Size of
+    each printed structure is kept within about half of `max_message_size`
+    characters, whatever the size of the structure is.
+
+    :py:class:`numpy.ndarray` values are compared natively if NumPy is
+    installed. Shape and dtype of arrays should match, then arrays are compared
+    elementwise, and path to the first differing element is reported like
+    ``/features.0.3.1``. If `rtol` or `atol` is given, numeric arrays are
+    compared with that relative or absolute tolerance as by
+    :py:func:`numpy.isclose`, otherwise they should be exactly equal.
+
+    If `ignore_list_order=True`, lists at any level are compared as multisets,
+    i.e. items of a list in `actual` should match items of a corresponding list
+    in `expected` in any order. Tuples are still compared positionally. Items
+    which could be hashed structurally are matched through a hash table, only
+    the rest of them are tried against each other pairwise. Dicts are tried
+    only against dicts sharing a value of some key with them, and items are
+    matched so that as many of them as possible find a match. Items that have
+    no match on the other side are listed in the failure message.
+
+    Binary values, i.e. :py:class:`bytearray`, :py:class:`memoryview` and byte
+    strings longer than 256 bytes, are compared without copying. If they differ,
+    offset of the first differing byte is reported along with few bytes around
+    it in hex, instead of whole values.
+
+    Sets are compared with set algebra. Failure message names few of members
+    which are missing or unexpected in `actual` and tells how many of them
+    there are in total.
+
+    Iterators, generators and other iterables that are not sequences, sets or
+    mappings are compared against lists, tuples or each other lazily. Items
+    are taken from both sides in lockstep, compared, and forgotten, so
+    iterables are never materialized. Order of their items matters even if
+    `ignore_list_order=True`. Iterables whose classes define their own
+    equality, e.g. :py:class:`~collections.deque`, are compared with it.
+
+    `expected` may also be a :py:class:`Fingerprint` of an expected structure.
+    Then `actual` is hashed in a single pass and compared with precomputed
+    hashes of `expected` subtrees. Only subtrees whose hashes differ are
+    compared as usual.
     """
-    try:
-        _assert_deep_equal(actual, expected, [], ignore_extra_keys=ignore_extra_keys)
-    except AssertionError, e:
+    comparison = _Comparison(ignore_extra_keys=ignore_extra_keys, max_diffs=max_diffs,
+                             rtol=rtol, atol=atol, ignore_list_order=ignore_list_order)
+    if isinstance(expected, Fingerprint):
+        comparison.expected_digests = expected.digests
+        comparison.actual_digests = {}
+        _digest_tree(actual, comparison.actual_digests)
+        expected = expected.obj
+    comparison.run(actual, expected)
+    instrument.add_nodes(comparison.nodes)
+    if comparison.diffs:
         if not msg:
+            path = _path_keys(comparison.diffs[0][0])
+            budget = max_message_size // 2
             msg = "\n-------------------------------- Expected -----------------------------------\n"
-            msg += _format(expected)
+            msg += _format(expected, path, budget)
             msg += "\n--------------------------------- Actual ------------------------------------\n"
-            msg += _format(actual)
-            msg += "\n\n" + str(e)
+            msg += _format(actual, path, budget)
+            msg += "\n\n" + comparison.report()
         raise AssertionError(msg)
 
 
-def _format(obj):
-    # simplify to make sure it is pretty printed
-    return pprint.pformat(_simplify(obj))
+def _sample(members):
+    """Format few of `members` and count of the rest"""
+    sample = list(itertools.islice(members, _SET_SAMPLE))
+    text = _short_repr(sample, _VALUE_LIMIT)[0]
+    if len(members) > len(sample):
+        text += ' and %s more' % (len(members) - len(sample))
+    return text
+
+
+def _first_difference(a, b):
+    """Return offset of the first differing byte of memoryviews `a` and `b`.
+
+    Views are compared chunk by chunk and then the differing chunk is
+    bisected, slices of memoryviews are not copied.
+    """
+    length = min(len(a), len(b))
+    start = 0
+    while start < length:
+        end = min(start + _BUFFER_CHUNK, length)
+        if a[start:end] != b[start:end]:
+            break
+        start = end
+    else:
+        # one is a prefix of another
+        return length
+
+    while end - start > 1:
+        middle = (start + end) // 2
+        if a[start:middle] != b[start:middle]:
+            end = middle
+        else:
+            start = middle
+    return start
+
+
+def _hex_window(view, offset):
+    """Format bytes around `offset` in hex with the byte at `offset` marked"""
+    start = max(0, offset - _BUFFER_WINDOW)
+    end = min(len(view), offset + _BUFFER_WINDOW + 1)
+    before = binascii.hexlify(view[start:offset].tobytes())
+    at = binascii.hexlify(view[offset:offset + 1].tobytes())
+    after = binascii.hexlify(view[offset + 1:end].tobytes())
+    return '%s%s[%s]%s%s' % ('...' if start > 0 else '', before, at or 'end', after,
+                             '...' if end < len(view) else '')
+
+
+class Fingerprint(object):
+    """
+    Holds a structure to be passed as `expected` to
+    :py:func:`assert_deep_equal` many times, along with precomputed hashes
+    of all its subtrees.
+
+    Hashes are computed Merkle-style: hash of a dict or a list is built from
+    hashes of its items. If hashes of a subtree in `actual` and of a
+    corresponding subtree in `expected` are equal, the subtrees are equal
+    too and aren't compared item by item::
+
+        EXPECTED = Fingerprint(load_fixture('response.json'))
+
+        def test_response(self):
+            assert_deep_equal(fetch_response(), EXPECTED)
+
+    Only dicts, lists, tuples and values of built-in scalar types, plain
+    NumPy arrays included, are hashed. Subtrees containing anything else,
+    e.g. :py:class:`~testmania.expect.Expectation` objects, are always
+    compared as usual. The structure should not be changed after it is
+    fingerprinted.
+    """
+
+    def __init__(self, obj):
+        self.obj = obj
+        # maps ids of containers within `obj` to their hashes
+        self.digests = {}
+        self.digest = _digest_tree(obj, self.digests)
+
+    def __repr__(self):
+        return '<Fingerprint %s>' % _short_repr(self.obj, _VALUE_LIMIT)[0]
+
+
+_DIGESTIBLE_TYPES = frozenset([str, unicode, int, long, float, bool, type(None)])
+
+
+def _leaf_token(x):
+    """Return string uniquely identifying scalar `x` or None. NaN isn't
+    equal to itself, so floats and arrays holding it get None too."""
+    t = type(x)
+    if t is unicode:
+        data = x.encode('utf-8')
+    elif t in _DIGESTIBLE_TYPES:
+        if t is float and x != x:
+            return None
+        data = repr(x)
+    elif numpy is not None and t is numpy.ndarray and x.dtype != object:
+        if x.dtype.kind in 'fc' and numpy.isnan(x).any():
+            return None
+        data = '%s%s:%s' % (x.dtype.str, x.shape, x.tobytes())
+    else:
+        return None
+    return '%s%s:%s' % (t.__name__, len(data), data)
+
+
+def _digest_tree(obj, digests):
+    """Compute hashes of all containers in `obj` and store them to `digests`
+    by container ids. Return hash of `obj` itself, None if it can't be hashed.
+    """
+    kinds = _KINDS
+    kind = _kind(obj)
+    if kind not in _CONTAINER_KINDS:
+        return _leaf_token(obj)
+
+    # post-order walk, containers in progress have None hash, so that
+    # reference cycles get no hash
+    stack = [(obj, kind, False)]
+    while stack:
+        node, kind, children_done = stack.pop()
+        if not children_done:
+            if id(node) in digests:
+                continue
+            digests[id(node)] = None
+            stack.append((node, kind, True))
+            for item in (node.itervalues() if kind == 'dict' else node):
+                item_kind = kinds.get(type(item), _UNKNOWN)
+                if item_kind is _UNKNOWN:
+                    item_kind = _kind(item)
+                if item_kind in _CONTAINER_KINDS:
+                    stack.append((item, item_kind, False))
+            continue
+
+        tokens = []
+        if kind == 'dict':
+            for key, value in node.iteritems():
+                key_token = _leaf_token(key)
+                value_token = _item_token(value, digests)
+                if key_token is None or value_token is None:
+                    break
+                tokens.append(key_token + value_token)
+            else:
+                tokens.sort()
+                digests[id(node)] = hashlib.md5('dict:' + ''.join(tokens)).digest()
+        else:
+            for item in node:
+                token = _item_token(item, digests)
+                if token is None:
+                    break
+                tokens.append(token)
+            else:
+                digests[id(node)] = hashlib.md5(kind + ':' + ''.join(tokens)).digest()
+
+    return digests[id(obj)]
+
+
+def _item_token(x, digests):
+    kind = _KINDS.get(type(x), _UNKNOWN)
+    if kind is _UNKNOWN:
+        kind = _kind(x)
+    if kind in _CONTAINER_KINDS:
+        digest = digests[id(x)]
+        return 'hash:' + digest if digest is not None else None
+    return _leaf_token(x)
+
+
+# container kinds of types, None for scalars
+_KINDS = {dict: 'dict', list: 'list', tuple: 'tuple', set: 'set', frozenset: 'set'}
+_CONTAINER_KINDS = frozenset(['dict', 'list', 'tuple'])
+_SEQUENCE_KINDS = frozenset(['list', 'tuple', 'iterable'])
+_UNKNOWN = object()
+
+
+def _kind(x):
+    """Return container kind of `x`: 'dict', 'list', 'tuple', 'set',
+    'iterable' for other iterables compared lazily, or None"""
+    if isinstance(x, (dict, UserDict)):
+        kind = 'dict'
+    elif isinstance(x, (list, UserList)):
+        kind = 'list'
+    elif isinstance(x, tuple):
+        kind = 'tuple'
+    elif isinstance(x, collections.Set):
+        kind = 'set'
+    elif isinstance(x, collections.Iterator) or \
+            isinstance(x, collections.Iterable) and \
+            not isinstance(x, (basestring, collections.Set, collections.Mapping) + _array_types) and \
+            type(x) not in _BUFFER_TYPES and not _defines_equality(x):
+        kind = 'iterable'
+    else:
+        kind = None
+    # instances of old-style classes all have the same type
+    if type(x) is not types.InstanceType:
+        _KINDS[type(x)] = kind
+    return kind
+
+
+def _defines_equality(x):
+    """Tell whether class of `x` compares its instances by its own rules,
+    e.g. :py:class:`~collections.deque`, which shouldn't be bypassed"""
+    return any('__eq__' in vars(cls) or '__cmp__' in vars(cls)
+               for cls in inspect.getmro(x.__class__) if cls is not object)
+
+
+def compile(expected, **options):
+    """Prepare a checker for many comparisons against the same `expected`.
+
+    Returns a callable which takes `actual` and optional `msg` and works like
+    :py:func:`assert_deep_equal` called with `expected` and `options`, but
+    faster. Use it when the same template is checked thousands of times::
+
+        check_response = compile(EXPECTED_RESPONSE, ignore_extra_keys=True)
+
+        for request in generate_requests():
+            check_response(handle(request))
+
+    `expected` is flattened to a list of simple instructions once. A call walks
+    the list instead of dispatching on types of both structures and building
+    key sets of `expected` again. If the check fails, `actual` is compared as
+    usual to produce exactly the same failure message as
+    :py:func:`assert_deep_equal` does. `expected` should not be changed after
+    it is compiled.
+
+    `options` are keyword arguments of :py:func:`assert_deep_equal` other
+    than `msg`, which is passed to the checker on every call.
+    """
+    for name in options:
+        if name not in _COMPILE_OPTIONS:
+            raise TypeError("compile() got an unexpected keyword argument %r" % name)
+    return _CompiledChecker(expected, options)
+
+
+# options of assert_deep_equal that a checker is compiled with
+_COMPILE_OPTIONS = frozenset(inspect.getargspec(assert_deep_equal).args) - \
+    frozenset(['actual', 'expected', 'msg'])
+
+
+# instructions of a compiled checker
+_OP_LEAF = 0
+_OP_DICT = 1
+_OP_SEQUENCE = 2
+# compare with interpreter, for values that need special treatment
+_OP_INTERPRET = 3
+
+
+class _CompiledChecker(object):
+    def __init__(self, expected, options):
+        self.expected = expected
+        self.options = options
+        self.comparison_options = dict((name, value) for name, value in options.iteritems()
+                                       if name not in ('max_diffs', 'max_message_size'))
+        self.program = self._compile(expected)
+
+    def _compile(self, expected):
+        """Flatten `expected` to a list of ``(op, parent, key, arg)``
+        instructions in pre-order. `parent` is index of instruction for
+        the container to take `key` from, -1 for the root."""
+        ignore_list_order = self.options.get('ignore_list_order')
+        program = []
+        seen = set()
+        stack = [(expected, -1, None)]
+        while stack:
+            node, parent, key = stack.pop()
+            kind = _kind(node)
+            if kind in _CONTAINER_KINDS and id(node) in seen:
+                # shared subtrees and reference cycles are left to interpreter
+                kind = 'interpret'
+            elif kind == 'iterable':
+                # it can't be consumed now
+                kind = 'interpret'
+            elif kind == 'list' and ignore_list_order:
+                kind = 'interpret'
+            elif isinstance(node, _array_types):
+                kind = 'interpret'
+
+            index = len(program)
+            if kind == 'dict':
+                seen.add(id(node))
+                keys = node.keys()
+                program.append((_OP_DICT, parent, key, frozenset(keys)))
+                for k in reversed(keys):
+                    stack.append((node[k], index, k))
+            elif kind in ('list', 'tuple'):
+                seen.add(id(node))
+                program.append((_OP_SEQUENCE, parent, key, (kind, len(node))))
+                for i in xrange(len(node) - 1, -1, -1):
+                    stack.append((node[i], index, i))
+            elif kind == 'interpret':
+                program.append((_OP_INTERPRET, parent, key, node))
+            else:
+                program.append((_OP_LEAF, parent, key, node))
+        return program
+
+    def __call__(self, actual, msg=None):
+        if not self.matches(actual):
+            assert_deep_equal(actual, self.expected, msg=msg, **self.options)
+
+    def matches(self, actual):
+        kinds = _KINDS
+        ignore_extra_keys = self.options.get('ignore_extra_keys')
+        # actual values corresponding to instructions for containers
+        values = [None] * len(self.program)
+        try:
+            for index, (op, parent, key, arg) in enumerate(self.program):
+                x = values[parent][key] if parent >= 0 else actual
+                if op == _OP_LEAF:
+                    if x is not arg and x != arg:
+                        return False
+                    continue
+
+                kind = kinds.get(type(x), _UNKNOWN)
+                if kind is _UNKNOWN:
+                    kind = _kind(x)
+                if op == _OP_DICT:
+                    if kind != 'dict':
+                        return False
+                    keys = x.viewkeys() if type(x) is dict else set(x.keys())
+                    if ignore_extra_keys:
+                        if not keys >= arg:
+                            return False
+                    elif keys != arg:
+                        return False
+                elif op == _OP_SEQUENCE:
+                    if (kind, len(x)) != arg:
+                        return False
+                elif kind == 'iterable':
+                    # comparing it would consume it before the fallback does
+                    return False
+                else:
+                    comparison = _Comparison(**self.comparison_options)
+                    comparison.run(x, arg)
+                    if comparison.diffs:
+                        return False
+                values[index] = x
+        except Exception:
+            # e.g. ambiguous comparison results; let interpreter decide
+            return False
+        return True
+
+
+# how many chars of a value are printed in a description of a difference
+_VALUE_LIMIT = 500
+# how many levels above a difference are printed in a failure message
+_WINDOW_DEPTH = 8
+# how many siblings are printed on each level around a difference
+_WINDOW_SIBLINGS = 2
+
+
+def _format(obj, path, budget):
+    """Pretty print `obj` if it is small, or a window around `path` otherwise"""
+    text, cut = _short_repr(obj, budget)
+    if not cut:
+        try:
+            # simplify to make sure it is pretty printed
+            return pprint.pformat(_simplify(obj))
+        except RuntimeError:
+            # small but too deeply nested for recursive pprint
+            pass
+    return _format_window(obj, path, budget)
+
+
+def _format_window(obj, path, budget):
+    lines = []
+    skip = max(0, len(path) - _WINDOW_DEPTH)
+    if skip:
+        lines.append("...%s levels up..." % skip)
+        for key in path[:skip]:
+            try:
+                obj = obj[key]
+            except (LookupError, TypeError):
+                # e.g. an iterator which is consumed already
+                break
+    # siblings share what is left after the path itself is printed
+    sibling_limit = max(20, budget // (4 * _WINDOW_SIBLINGS * (len(path) - skip + 1)))
+    _format_window_level(lines, obj, path[skip:], '', '', '', budget // 4, sibling_limit)
+
+    text = '\n'.join(lines)
+    if len(text) > budget:
+        text = text[:budget] + '...'
+    return text
+
+
+def _format_window_level(lines, obj, path, indent, prefix, suffix, leaf_limit, sibling_limit):
+    inner = indent + '    '
+    if path and isinstance(obj, (dict, UserDict)) and path[0] in obj:
+        key = path[0]
+        lines.append(indent + prefix + '{')
+        siblings = list(itertools.islice((k for k in obj if k != key), _WINDOW_SIBLINGS))
+        for k in siblings:
+            lines.append('%s%s: %s,' % (inner, _short_repr(k, sibling_limit)[0],
+                                        _short_repr(obj[k], sibling_limit)[0]))
+        _format_window_level(lines, obj[key], path[1:], inner, '%r: ' % (key,), ',',
+                             leaf_limit, sibling_limit)
+        skipped = len(obj) - len(siblings) - 1
+        if skipped:
+            lines.append('%s...%s more keys...' % (inner, skipped))
+        lines.append(indent + '}' + suffix)
+
+    elif path and isinstance(obj, (list, UserList, tuple)) and \
+            isinstance(path[0], (int, long)) and 0 <= path[0] < len(obj):
+        index = path[0]
+        opener, closer = ('(', ')') if isinstance(obj, tuple) else ('[', ']')
+        lines.append(indent + prefix + opener)
+        first = max(0, index - _WINDOW_SIBLINGS // 2)
+        last = min(len(obj), first + _WINDOW_SIBLINGS + 1)
+        if first:
+            lines.append('%s...%s items...' % (inner, first))
+        for i in xrange(first, last):
+            if i == index:
+                _format_window_level(lines, obj[i], path[1:], inner, '', ',',
+                                     leaf_limit, sibling_limit)
+            else:
+                lines.append('%s%s,' % (inner, _short_repr(obj[i], sibling_limit)[0]))
+        if last < len(obj):
+            lines.append('%s...%s items...' % (inner, len(obj) - last))
+        lines.append(indent + closer + suffix)
+
+    else:
+        lines.append(indent + prefix + _short_repr(obj, leaf_limit)[0] + suffix)
+
+
+class _Items(object):
+    """Container being printed by `_short_repr`"""
+    __slots__ = ('iterator', 'closer', 'is_dict', 'started')
+
+    def __init__(self, iterator, closer, is_dict=False):
+        self.iterator = iterator
+        self.closer = closer
+        self.is_dict = is_dict
+        self.started = False
+
+
+def _short_repr(obj, limit):
+    """Return repr of `obj` cut to `limit` chars and whether it was cut.
+
+    Unlike :py:mod:`repr` module it never sorts or copies containers, and
+    visits only as much of `obj` as it takes to fill `limit`.
+    """
+    chunks = []
+    size = 0
+    stack = [obj]
+    while stack and size <= limit:
+        x = stack.pop()
+        if isinstance(x, _Items):
+            for item in x.iterator:
+                stack.append(x)
+                if x.started:
+                    chunks.append(', ')
+                    size += 2
+                x.started = True
+                if x.is_dict:
+                    key, item = item
+                    text = _short_repr(key, limit - size)[0] + ': '
+                    chunks.append(text)
+                    size += len(text)
+                stack.append(item)
+                break
+            else:
+                chunks.append(x.closer)
+                size += len(x.closer)
+            continue
+
+        if isinstance(x, (dict, UserDict)):
+            text = '{'
+            stack.append(_Items(x.iteritems(), '}', is_dict=True))
+        elif isinstance(x, (list, UserList)):
+            text = '['
+            stack.append(_Items(iter(x), ']'))
+        elif isinstance(x, tuple):
+            text = '('
+            stack.append(_Items(iter(x), ',)' if len(x) == 1 else ')'))
+        elif isinstance(x, (set, frozenset)):
+            text = '%s([' % type(x).__name__
+            stack.append(_Items(iter(x), '])'))
+        elif isinstance(x, basestring) and len(x) > limit:
+            text = repr(x[:limit])
+        elif isinstance(x, bytearray):
+            text = 'bytearray(%r)' % str(x[:limit])
+        else:
+            text = repr(x)
+        chunks.append(text)
+        size += len(text)
+
+    text = ''.join(chunks)
+    if stack or size > limit:
+        return text[:limit] + '...', True
+    return text, False
 
 
 def _simplify(x):
@@ -95,36 +654,549 @@ def _simplify(x):
     return result
 
 
-def _assert_deep_equal(actual, expected, path, ignore_extra_keys):
-    path_str = '/' + '.'.join(map(str, path))
-    if isinstance(actual, (dict, UserDict)) and isinstance(expected, (dict, UserDict)):
-        actual_keys = set(actual.keys())
-        expected_keys = set(expected.keys())
-        actual_key_extra = actual_keys - expected_keys
-        if actual_key_extra and not ignore_extra_keys:
-            msg = "at %s, actual got unexpected keys %s" % (path_str, list(actual_key_extra))
-            raise AssertionError(msg)
-
-        expected_key_extra = expected_keys - actual_keys
-        if expected_key_extra:
-            msg = "at %s, expected keys %s are absent in actual" % (path_str, list(expected_key_extra))
-            raise AssertionError(msg)
-
-        for key in expected_keys:
-            _assert_deep_equal(actual[key], expected[key], path + [key], ignore_extra_keys)
-
-    elif isinstance(actual, (list, UserList)) and isinstance(expected, (list, UserList)) or \
-            isinstance(actual, tuple) and isinstance(expected, tuple):
-        actual_len = len(actual)
-        expected_len = len(expected)
+def _path_str(path):
+    """Build ``/a.b.0`` string from a linked path.
+
+    Path is either ``None`` for the root or a ``(parent_path, key)`` pair. It is
+    cheap to extend while descending and is turned to string only on failure.
+    """
+    return '/' + '.'.join(map(str, _path_keys(path)))
+
+
+def _path_keys(path):
+    """Turn a linked path to a list of keys"""
+    keys = []
+    while path is not None:
+        path, key = path
+        keys.append(key)
+    keys.reverse()
+    return keys
+
+
+_array_types = (numpy.ndarray,) if numpy is not None else ()
+
+# binary values compared as buffers, byte strings are compared
+# that way only if they are longer than `_BLOB_SIZE`
+_BUFFER_TYPES = frozenset([bytearray, memoryview, buffer])
+_BLOB_SIZE = 256
+# how many bytes are compared at once while looking for a difference
+_BUFFER_CHUNK = 64 * 1024
+# how many bytes around a difference are printed
+_BUFFER_WINDOW = 8
+
+# how many members of sets are named in a description of a difference
+_SET_SAMPLE = 10
+
+_NOT_CANONICAL = object()
+_END = object()
+
+
+class _NotCanonical(Exception):
+    pass
+
+
+class _Mismatch(Exception):
+    """Stops a probing comparison at the first difference"""
+
+
+class _Repr(object):
+    """Value in a description of a difference, which is turned to its short
+    repr only if the description is formatted"""
+    __slots__ = ('obj', 'convert')
+
+    def __init__(self, obj, convert=None):
+        self.obj = obj
+        self.convert = convert
+
+    def __str__(self):
+        obj = self.convert(self.obj) if self.convert is not None else self.obj
+        return _short_repr(obj, _VALUE_LIMIT)[0]
+
+
+def _max_matching(candidates, matches):
+    """Match as many items as possible to their candidates, each candidate
+    to one item at most.
+
+    `candidates` is a list of candidates of each item, `matches(item,
+    candidate)` tells whether an item with that index matches a candidate,
+    it is called once per pair at most. Items take free matching candidates
+    first, the rest are matched along augmenting paths, which take
+    candidates from items that can be rematched. Returns a dict mapping
+    candidates to indexes of items matched to them.
+    """
+    results = {}
+
+    def match(item, candidate):
+        pair = (item, candidate)
+        result = results.get(pair)
+        if result is None:
+            result = results[pair] = matches(item, candidate)
+        return result
+
+    owners = {}
+    left = []
+    for item, item_candidates in enumerate(candidates):
+        for candidate in item_candidates:
+            if candidate not in owners and match(item, candidate):
+                owners[candidate] = item
+                break
+        else:
+            left.append(item)
+
+    for item in left:
+        # depth-first search with an explicit stack of items along with
+        # their candidates to try, `path` holds candidates taken on the way
+        seen = set()
+        stack = [(item, iter(candidates[item]))]
+        path = []
+        while stack:
+            current, rest = stack[-1]
+            for candidate in rest:
+                if candidate in seen or not match(current, candidate):
+                    continue
+                seen.add(candidate)
+                path.append(candidate)
+                owner = owners.get(candidate)
+                if owner is None:
+                    for (taker, _), taken in zip(stack, path):
+                        owners[taken] = taker
+                    stack = []
+                else:
+                    stack.append((owner, iter(candidates[owner])))
+                break
+            else:
+                stack.pop()
+                if path:
+                    path.pop()
+    return owners
+
+
+class _Comparison(object):
+    """Deep comparison of a pair of structures collecting found differences.
+
+    Structures are walked depth-first with an explicit stack, so there is no
+    recursion limit on nesting depth and no frame overhead per node. Children
+    are pushed in reverse order so that they are visited in the same order as
+    with a recursive walk.
+
+    Pairs that are the very same object are not walked at all. Container
+    pairs already visited are remembered by ids, so subtrees shared in a DAG
+    are compared once and reference cycles do not loop forever.
+    """
+
+    def __init__(self, ignore_extra_keys=False, max_diffs=1, rtol=None, atol=None,
+                 ignore_list_order=False):
+        self.ignore_extra_keys = ignore_extra_keys
+        self.max_diffs = max_diffs
+        self.rtol = rtol
+        self.atol = atol
+        self.ignore_list_order = ignore_list_order
+        # hashes of containers by their ids, if `expected` is fingerprinted
+        self.expected_digests = None
+        self.actual_digests = None
+        # list of (path, description) pairs
+        self.diffs = []
+        # number of pairs of values popped from the stack
+        self.nodes = 0
+        # maps ids of visited container pairs to the pairs themselves to keep
+        # them alive while the comparison lasts, so ids are never reused
+        self.visited = {}
+        # whether the comparison only tells if structures match
+        self.probing = False
+        # probing comparison for items of unordered lists, made on demand
+        self.prober = None
+
+    def run(self, actual, expected, path=None):
+        ignore_extra_keys = self.ignore_extra_keys
+        visited = self.visited
+        expected_digests = self.expected_digests
+        actual_digests = self.actual_digests
+        kinds = _KINDS
+        stack = [(actual, expected, path)]
+        pop = stack.pop
+        push = stack.append
+        nodes = 0
+        try:
+            while stack:
+                actual, expected, path = pop()
+                nodes += 1
+                if actual is expected:
+                    continue
+
+                if expected_digests is not None:
+                    digest = expected_digests.get(id(expected))
+                    if digest is not None and digest == actual_digests.get(id(actual)):
+                        continue
+
+                # container kinds are cached per type, isinstance checks against
+                # UserList and other ABCs are too slow to do for every node
+                actual_kind = kinds.get(type(actual), _UNKNOWN)
+                if actual_kind is _UNKNOWN:
+                    actual_kind = _kind(actual)
+                expected_kind = kinds.get(type(expected), _UNKNOWN)
+                if expected_kind is _UNKNOWN:
+                    expected_kind = _kind(expected)
+
+                if actual_kind == 'dict' and expected_kind == 'dict':
+                    pair_id = (id(actual), id(expected))
+                    if pair_id in visited:
+                        continue
+                    visited[pair_id] = (actual, expected)
+
+                    actual_keys = set(actual.keys())
+                    expected_keys = set(expected.keys())
+                    actual_key_extra = actual_keys - expected_keys
+                    if actual_key_extra and not ignore_extra_keys:
+                        if self.add_diff(path, "actual got unexpected keys %s",
+                                         _Repr(actual_key_extra, list)):
+                            return
+
+                    expected_key_extra = expected_keys - actual_keys
+                    if expected_key_extra:
+                        if self.add_diff(path, "expected keys %s are absent in actual",
+                                         _Repr(expected_key_extra, list)):
+                            return
+                        expected_keys -= expected_key_extra
+
+                    for key in reversed(list(expected_keys)):
+                        push((actual[key], expected[key], (path, key)))
+
+                elif actual_kind == 'iterable' and expected_kind in _SEQUENCE_KINDS or \
+                        expected_kind == 'iterable' and actual_kind in _SEQUENCE_KINDS:
+                    if self.compare_lazy(actual, expected, path):
+                        return
+
+                elif actual_kind == 'set' and expected_kind == 'set':
+                    if actual != expected and self.compare_sets(actual, expected, path):
+                        return
+
+                elif actual_kind is not None and actual_kind == expected_kind:
+                    # both are lists or both are tuples
+                    pair_id = (id(actual), id(expected))
+                    if pair_id in visited:
+                        continue
+                    visited[pair_id] = (actual, expected)
+
+                    if self.ignore_list_order and actual_kind == 'list':
+                        if self.compare_unordered(actual, expected, path):
+                            return
+                        continue
+
+                    actual_len = len(actual)
+                    expected_len = len(expected)
+                    if actual_len != expected_len:
+                        if self.add_diff(path, "expected length is %s, actual length is %s",
+                                         expected_len, actual_len):
+                            return
+                    # items of common length are still worth comparing
+                    # if more differences are wanted
+                    for i in xrange(min(actual_len, expected_len) - 1, -1, -1):
+                        push((actual[i], expected[i], (path, i)))
+                elif isinstance(actual, _array_types) or isinstance(expected, _array_types):
+                    if self.compare_arrays(actual, expected, path):
+                        return
+
+                elif type(actual) in _BUFFER_TYPES or type(expected) in _BUFFER_TYPES or \
+                        type(actual) is str and type(expected) is str and \
+                        (len(actual) > _BLOB_SIZE or len(expected) > _BLOB_SIZE):
+                    if self.compare_buffers(actual, expected, path):
+                        return
+
+                else:
+                    if actual != expected:
+                        if self.add_diff(path, "expected %s, got %s",
+                                         _Repr(expected), _Repr(actual)):
+                            return
+        finally:
+            self.nodes += nodes
+
+    def compare_buffers(self, actual, expected, path):
+        """Compare binary values without copying them, return whether
+        comparison should stop"""
+        try:
+            actual_view = memoryview(actual)
+            expected_view = memoryview(expected)
+        except TypeError:
+            # e.g. unicode against bytes
+            if actual != expected:
+                return self.add_diff(path, "expected %s, got %s", _Repr(expected), _Repr(actual))
+            return False
+
+        actual_len = len(actual_view)
+        expected_len = len(expected_view)
+        if actual_len == expected_len and actual_view == expected_view:
+            return False
+        if self.probing:
+            raise _Mismatch()
+
+        offset = _first_difference(actual_view, expected_view)
+        description = "buffers differ at offset %s, expected %s, got %s" % \
+            (offset, _hex_window(expected_view, offset), _hex_window(actual_view, offset))
         if actual_len != expected_len:
-            raise AssertionError(
-                "at % s, expected length is %s, actual length is %s" %
-                (path_str, expected_len, actual_len))
-        for i in xrange(actual_len):
-            _assert_deep_equal(actual[i], expected[i], path + [i], ignore_extra_keys)
-    else:
-        if actual != expected:
-            raise AssertionError(
-                "at % s, expected %r, got %r" %
-                (path_str, expected, actual))
+            description += " (expected length is %s, actual length is %s)" % \
+                (expected_len, actual_len)
+        return self.add_diff(path, description)
+
+    def compare_sets(self, actual, expected, path):
+        """Report members that differ, return whether comparison should stop"""
+        if self.probing:
+            raise _Mismatch()
+        descriptions = []
+        extra = actual - expected
+        if extra:
+            descriptions.append("actual got unexpected members %s" % _sample(extra))
+        missing = expected - actual
+        if missing:
+            descriptions.append("expected members %s are absent in actual" % _sample(missing))
+        return self.add_diff(path, ', '.join(descriptions))
+
+    def compare_lazy(self, actual, expected, path):
+        """Compare iterables consuming them in lockstep, return whether
+        comparison should stop"""
+        actual_items = iter(actual)
+        expected_items = iter(expected)
+        # ids of transient items may be reused once they are compared,
+        # so every pair of items gets its own memo
+        visited = self.visited
+        try:
+            for index in itertools.count():
+                actual_item = next(actual_items, _END)
+                expected_item = next(expected_items, _END)
+                if actual_item is _END and expected_item is _END:
+                    return False
+                if actual_item is _END:
+                    return self.add_diff((path, index), "expected %s, actual has no more items",
+                                         _Repr(expected_item))
+                if expected_item is _END:
+                    return self.add_diff((path, index), "expected no more items, got %s",
+                                         _Repr(actual_item))
+                self.visited = {}
+                self.run(actual_item, expected_item, (path, index))
+                if len(self.diffs) >= self.max_diffs:
+                    return True
+        finally:
+            self.visited = visited
+
+    def compare_unordered(self, actual, expected, path):
+        """Match items of lists regardless of their order, return whether
+        comparison should stop"""
+        # canonical form of expected item -> indexes of items having it
+        buckets = collections.defaultdict(list)
+        loose = []
+        for i, item in enumerate(expected):
+            key = self.canonical(item)
+            if key is _NOT_CANONICAL:
+                loose.append(i)
+            else:
+                buckets[key].append(i)
+
+        unmatched = []
+        for item in actual:
+            key = self.canonical(item)
+            if key is not _NOT_CANONICAL:
+                candidates = buckets.get(key)
+                if candidates:
+                    candidates.pop()
+                    continue
+            unmatched.append((item, key))
+
+        rest = [i for candidates in buckets.itervalues() for i in candidates]
+        if unmatched and (loose or rest):
+            owners = self.match_pairwise(unmatched, expected, loose, rest)
+            matched = set(owners.itervalues())
+            actual_extra = [item for i, (item, _) in enumerate(unmatched) if i not in matched]
+            expected_extra = [expected[i] for i in sorted(set(loose + rest).difference(owners))]
+        else:
+            actual_extra = [item for item, _ in unmatched]
+            expected_extra = [expected[i] for i in sorted(loose + rest)]
+
+        if not actual_extra and not expected_extra:
+            return False
+        if self.probing:
+            raise _Mismatch()
+        descriptions = []
+        if actual_extra:
+            descriptions.append("actual got unexpected items %s" %
+                                _short_repr(actual_extra, _VALUE_LIMIT)[0])
+        if expected_extra:
+            descriptions.append("expected items %s are absent in actual" %
+                                _short_repr(expected_extra, _VALUE_LIMIT)[0])
+        return self.add_diff(path, ', '.join(descriptions))
+
+    def match_pairwise(self, unmatched, expected, loose, rest):
+        """Match `unmatched` pairs of actual items and their canonical forms
+        to `expected` items at `loose` and `rest` indexes by probing pairs of
+        them, return a dict mapping indexes of expected items to indexes of
+        pairs matched to them.
+
+        Only pairs that may match are probed. Items having canonical form
+        could only match `loose` expected items, otherwise they'd be matched
+        by it already. An expected dict is indexed by one of its items that
+        has canonical form, so it is tried only against actual dicts having
+        the same item. Other expected items are tried against every actual
+        item.
+        """
+        key_items = {}
+        key_counts = collections.Counter()
+        anyhow_loose = []
+        anyhow_rest = []
+        for anyhow, indexes in [(anyhow_loose, loose), (anyhow_rest, rest)]:
+            for i in indexes:
+                item = expected[i]
+                canonical = []
+                if _kind(item) == 'dict':
+                    for key, value in item.iteritems():
+                        value_key = self.canonical(value)
+                        if value_key is not _NOT_CANONICAL:
+                            canonical.append((key, value_key))
+                if canonical:
+                    key_items[i] = canonical
+                    key_counts.update(key for key, _ in canonical)
+                else:
+                    anyhow.append(i)
+
+        # index dicts by the key most of them share, e.g. an id, so that an
+        # actual dict is looked up by few of its keys
+        anchors = collections.defaultdict(lambda: collections.defaultdict(list))
+        for i, canonical in key_items.iteritems():
+            key, value_key = max(canonical, key=lambda key_item: key_counts[key_item[0]])
+            anchors[key][value_key].append(i)
+
+        loose_indexes = frozenset(loose)
+        candidates = []
+        for item, item_key in unmatched:
+            anchored = []
+            kind = _kind(item)
+            if kind == 'dict':
+                for key, by_value in anchors.iteritems():
+                    if key not in item:
+                        continue
+                    value_key = self.canonical(item[key])
+                    if value_key is _NOT_CANONICAL:
+                        # e.g. an iterator, which may still match
+                        for matching in by_value.itervalues():
+                            anchored.extend(matching)
+                    else:
+                        anchored.extend(by_value.get(value_key, ()))
+            elif kind is None and type(item) not in _DIGESTIBLE_TYPES and \
+                    not isinstance(item, _array_types):
+                # a value of unknown type may be equal to a dict
+                for by_value in anchors.itervalues():
+                    for matching in by_value.itervalues():
+                        anchored.extend(matching)
+
+            if item_key is _NOT_CANONICAL:
+                candidates.append(anyhow_loose + anyhow_rest + anchored)
+            else:
+                candidates.append(anyhow_loose + [i for i in anchored if i in loose_indexes])
+
+        return _max_matching(candidates,
+                             lambda a, e: self.probe(unmatched[a][0], expected[e]))
+
+    def canonical(self, x):
+        """Return hashable structural form of `x` such that equal canonical
+        forms mean equal values, or `_NOT_CANONICAL`"""
+        try:
+            return self._canonical(x)
+        except (TypeError, RuntimeError, _NotCanonical):
+            # unhashable or too deeply nested
+            return _NOT_CANONICAL
+
+    def _canonical(self, x):
+        kind = _KINDS.get(type(x), _UNKNOWN)
+        if kind is _UNKNOWN:
+            kind = _kind(x)
+        if kind == 'dict':
+            if self.ignore_extra_keys:
+                # equal values might have different keys
+                raise _NotCanonical()
+            return (dict, frozenset([(k, self._canonical(v)) for k, v in x.iteritems()]))
+        if kind == 'list':
+            items = [self._canonical(i) for i in x]
+            if self.ignore_list_order:
+                return (list, frozenset(collections.Counter(items).iteritems()))
+            return (list, tuple(items))
+        if kind == 'tuple':
+            return (tuple, tuple([self._canonical(i) for i in x]))
+        if kind == 'set':
+            return frozenset(x)
+        if kind == 'iterable' or isinstance(x, _array_types):
+            raise _NotCanonical()
+        if type(x) not in _DIGESTIBLE_TYPES or x != x:
+            # other values, e.g. Expectation objects, may be equal to
+            # values they don't hash equal to, and NaN isn't equal to itself
+            raise _NotCanonical()
+        return x
+
+    def probe(self, actual, expected):
+        """Tell whether `actual` matches `expected` without recording
+        differences"""
+        prober = self.prober
+        if prober is None:
+            prober = self.prober = _Comparison(ignore_extra_keys=self.ignore_extra_keys,
+                                               rtol=self.rtol, atol=self.atol,
+                                               ignore_list_order=self.ignore_list_order)
+            prober.probing = True
+        # pairs visited by a probe that stopped may not be equal
+        prober.visited = {}
+        try:
+            prober.run(actual, expected)
+        except _Mismatch:
+            return False
+        return True
+
+    def compare_arrays(self, actual, expected, path):
+        """Compare NumPy arrays, return whether comparison should stop"""
+        if not (isinstance(actual, numpy.ndarray) and isinstance(expected, numpy.ndarray)):
+            return self.add_diff(path, "expected %s, got %s", _Repr(expected), _Repr(actual))
+        if actual.shape != expected.shape:
+            return self.add_diff(path, "expected array of shape %s, actual shape is %s",
+                                 expected.shape, actual.shape)
+        if actual.dtype != expected.dtype:
+            return self.add_diff(path, "expected array of dtype %s, actual dtype is %s",
+                                 expected.dtype, actual.dtype)
+
+        tolerance = ''
+        if (self.rtol is not None or self.atol is not None) and \
+                numpy.issubdtype(expected.dtype, numpy.number):
+            rtol = self.rtol or 0
+            atol = self.atol or 0
+            equal = numpy.isclose(actual, expected, rtol=rtol, atol=atol)
+            tolerance = ' (rtol=%s, atol=%s)' % (rtol, atol)
+        else:
+            equal = actual == expected
+            if not isinstance(equal, numpy.ndarray):
+                # elementwise comparison is not supported for the dtype
+                return self.add_diff(path, "expected %s, got %s", _Repr(expected), _Repr(actual))
+        if equal.all():
+            return False
+        if self.probing:
+            raise _Mismatch()
+
+        index = numpy.unravel_index(numpy.argmin(equal), equal.shape)
+        for i in index:
+            path = (path, int(i))
+        return self.add_diff(path, "expected %s, got %s%s" %
+                             (_short_repr(expected[index], _VALUE_LIMIT)[0],
+                              _short_repr(actual[index], _VALUE_LIMIT)[0],
+                              tolerance))
+
+    def add_diff(self, path, description, *args):
+        """Record a difference, return whether comparison should stop.
+
+        `description` is formatted with `args` only once it is recorded, a
+        probing comparison raises `_Mismatch` instead.
+        """
+        if self.probing:
+            raise _Mismatch()
+        if args:
+            description %= args
+        self.diffs.append((path, description))
+        return len(self.diffs) >= self.max_diffs
+
+    def report(self):
+        lines = ["at %s, %s" % (_path_str(path), description)
+                 for path, description in self.diffs]
+        if len(self.diffs) > 1 and len(self.diffs) >= self.max_diffs:
+            lines.append("stopped after %s differences" % len(self.diffs))
+        return '\n'.join(lines)
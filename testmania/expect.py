@@ -52,6 +52,9 @@ if assertion is ok and fails with meaningful message that includes assertion
 failure text.
 """
 
+from testmania import instrument
+
+
 class Expectation(object):
     """
     Defines an object that holds an expectation about a value of the object
@@ -90,6 +93,7 @@ class Expectation(object):
             ' '.join('%s=%r' % item for item in self.kwargs.iteritems())
         )
 
+    @instrument.instrumented('Expectation.__eq__')
     def __eq__(self, other):
         try:
             self.assertion(other, *self.args, **self.kwargs)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8; -*-
+
+"""
+Instrumentation of testmania assertions to find out which of them take
+most of time of a test suite.
+
+It is off by default. Once enabled, every call of
+:py:func:`~testmania.deep.assert_deep_equal`,
+:py:func:`~testmania.json.assert_json_equal`,
+:py:func:`~testmania.xml.assert_xml_equal`,
+:py:func:`~testmania.time.assert_just_now` and comparison with
+:py:class:`~testmania.expect.Expectation` objects is recorded per call site,
+i.e. per line of test code that made the call::
+
+    from testmania import instrument
+
+    instrument.enable()
+    run_tests()
+    for stats in instrument.slowest(10):
+        print stats
+
+Assertions called from within other assertions, e.g. by expectations
+nested into a structure, are recorded too, with time included into time
+of the outer call.
+
+With pytest the same report is printed at the end of a session by a plugin
+which should be turned on explicitly::
+
+    py.test -p testmania.pytest_plugin
+
+When instrumentation is disabled the only overhead of an assertion call is
+a check of a global flag.
+"""
+
+import functools
+import inspect
+import sys
+import timeit
+
+
+_enabled = False
+# maps (assertion name, call site) pairs to `Stats`
+_registry = {}
+# `Stats` of assertions being run, innermost last
+_running = []
+
+
+class Stats(object):
+    """
+    Accumulated measurements of an assertion called from a call site.
+
+    :ivar name: name of the assertion.
+    :ivar site: ``filename:lineno`` of the call.
+    :ivar count: number of calls.
+    :ivar time: total wall time of calls in seconds.
+    :ivar nodes: total number of nodes of structures or documents visited.
+    :ivar message_bytes: total size of failure messages produced.
+    """
+
+    __slots__ = ('name', 'site', 'count', 'time', 'nodes', 'message_bytes')
+
+    def __init__(self, name, site):
+        self.name = name
+        self.site = site
+        self.count = 0
+        self.time = 0.0
+        self.nodes = 0
+        self.message_bytes = 0
+
+    def __repr__(self):
+        return '<Stats %s at %s: %s calls, %.6fs, %s nodes, %s message bytes>' % (
+            self.name, self.site, self.count, self.time, self.nodes, self.message_bytes)
+
+
+def enable():
+    """Start recording assertion calls"""
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """Stop recording assertion calls, recorded stats are kept"""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """Forget recorded stats"""
+    _registry.clear()
+
+
+def stats():
+    """Return list of :py:class:`Stats` recorded so far"""
+    return _registry.values()
+
+
+def slowest(count=10):
+    """Return `count` :py:class:`Stats` with the greatest total time"""
+    return sorted(_registry.itervalues(), key=lambda s: s.time, reverse=True)[:count]
+
+
+def add_nodes(count):
+    """Add `count` to the number of nodes visited by the assertion being run.
+    Does nothing if instrumentation is disabled."""
+    if _running:
+        _running[-1].nodes += count
+
+
+# wrapper of an instrumented function taking the same arguments, so that
+# its signature is seen by `inspect` and documentation tools
+_WRAPPER = """
+def %(name)s%(signature)s:
+    if not _instrument._enabled:
+        return _func%(call)s
+    return _instrument._record(_name, lambda: _func%(call)s)
+"""
+
+
+def instrumented(name):
+    """Decorator recording calls of an assertion function or method under
+    `name` when instrumentation is enabled"""
+    def decorator(func):
+        args, varargs, varkw, defaults = inspect.getargspec(func)
+        source = _WRAPPER % {
+            'name': func.__name__,
+            'signature': inspect.formatargspec(args, varargs, varkw),
+            'call': inspect.formatargspec(args, varargs, varkw, formatvalue=lambda value: ''),
+        }
+        namespace = {'__name__': __name__, '_instrument': sys.modules[__name__],
+                     '_func': func, '_name': name}
+        exec compile(source, '<instrumented %s>' % func.__name__, 'exec') in namespace
+        wrapper = namespace[func.__name__]
+        wrapper.func_defaults = defaults
+        return functools.wraps(func)(wrapper)
+    return decorator
+
+
+def _record(name, call):
+    site = _call_site()
+    key = (name, site)
+    stats = _registry.get(key)
+    if stats is None:
+        stats = _registry[key] = Stats(name, site)
+    stats.count += 1
+    _running.append(stats)
+    start = timeit.default_timer()
+    try:
+        return call()
+    except AssertionError, e:
+        message = e.args[0] if e.args else ''
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        stats.message_bytes += len(str(message))
+        raise
+    finally:
+        stats.time += timeit.default_timer() - start
+        _running.pop()
+
+
+def _call_site():
+    """Return ``filename:lineno`` of the innermost frame outside testmania"""
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_globals.get('__name__', '').startswith('testmania.'):
+        frame = frame.f_back
+    if frame is None:
+        return '?'
+    return '%s:%s' % (frame.f_code.co_filename, frame.f_lineno)
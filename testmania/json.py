@@ -0,0 +1,427 @@
+# -*- coding: utf-8; -*-
+
+from __future__ import absolute_import
+
+import codecs
+import re
+from json.decoder import scanstring
+
+from testmania import instrument
+from testmania.deep import _Comparison, _short_repr, _VALUE_LIMIT
+
+
+@instrument.instrumented('assert_json_equal')
+def assert_json_equal(actual, expected, msg=None, ignore_extra_keys=False):
+    """Test that two JSON documents are equal without loading them to memory.
+
+    `actual` and `expected` should be file-like objects opened for reading
+    or paths to files. Both documents are parsed incrementally and walked in
+    lockstep, so the comparison stops at the first difference without reading
+    the rest of the files. Memory used depends on nesting depth of documents,
+    not on their size.
+
+    Failure message contains path to the difference in the same format as
+    :py:func:`~testmania.deep.assert_deep_equal` does, e.g. ``/bar.1.tee``.
+    `ignore_extra_keys` has the same meaning too.
+
+    Objects are compared member by member while keys in both documents come in
+    the same order. Once the order differs, the rest of members of that object
+    in `expected` are loaded, and the rest of members in `actual` are compared
+    with them as they come. So memory used then depends on size of the rest of
+    that object in `expected`, which is the whole `expected` document if keys
+    of root objects go in different order.
+    """
+    actual_file = _open(actual)
+    try:
+        expected_file = _open(expected)
+        try:
+            comparison = _StreamComparison(ignore_extra_keys=ignore_extra_keys)
+            try:
+                comparison.run(_events(_tokens(actual_file)),
+                               _events(_tokens(expected_file)))
+            finally:
+                instrument.add_nodes(comparison.nodes)
+        finally:
+            if expected_file is not expected:
+                expected_file.close()
+    finally:
+        if actual_file is not actual:
+            actual_file.close()
+
+    if comparison.diffs:
+        raise AssertionError(msg or "\n\n" + comparison.report())
+
+
+def _open(source):
+    if hasattr(source, 'read'):
+        return source
+    return open(source, 'rb')
+
+
+_START_MAP = 'start_map'
+_END_MAP = 'end_map'
+_START_ARRAY = 'start_array'
+_END_ARRAY = 'end_array'
+_KEY = 'key'
+_VALUE = 'value'
+_EOF = 'eof'
+
+# a token preceded by whitespace: punctuation, start of a string,
+# a literal or a number
+_TOKEN_RE = re.compile(r"""
+    [ \t\n\r]*
+    (?:
+        ([{}\[\]:,])
+      | (")
+      | (true|false|null|NaN|Infinity|-Infinity)
+      | (-?(?:0|[1-9]\d*))(\.\d+)?([eE][-+]?\d+)?
+    )
+""", re.VERBOSE)
+_WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+_LITERALS = {
+    'true': True,
+    'false': False,
+    'null': None,
+    'NaN': float('nan'),
+    'Infinity': float('inf'),
+    '-Infinity': float('-inf'),
+}
+# long enough to tell any literal or a number from another
+_LOOKAHEAD = 10
+_CHUNK_SIZE = 64 * 1024
+
+
+def _tokens(fileobj):
+    """Read JSON tokens from a file chunk by chunk.
+
+    Tokens are ``(kind, value)`` pairs where kind is one of punctuation
+    characters, `_VALUE` for strings, numbers and literals, or `_EOF`.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    match_token = _TOKEN_RE.match
+    buf = u''
+    pos = 0
+    # tokens ending after `safe_end` may be incomplete until more data is read
+    safe_end = -_LOOKAHEAD
+    eof = False
+    while True:
+        match = match_token(buf, pos)
+        if not match or match.end() > safe_end:
+            if not eof:
+                # read at least as much as is buffered, so that a token that
+                # spans many chunks is rescanned only logarithmic number of times
+                data = fileobj.read(max(_CHUNK_SIZE, len(buf) - pos))
+                if isinstance(data, str):
+                    data = decoder.decode(data, final=not data)
+                if not data:
+                    eof = True
+                buf = buf[pos:] + data
+                pos = 0
+                safe_end = len(buf) - _LOOKAHEAD if not eof else len(buf)
+                continue
+            if not match:
+                if _WHITESPACE_RE.match(buf, pos).end() == len(buf):
+                    yield _EOF, None
+                    return
+                raise ValueError("Unexpected %r in JSON" % buf[pos:pos + _LOOKAHEAD].lstrip())
+
+        pos = match.end()
+        punctuation, quote, literal, integer, frac, exp = match.groups()
+        if punctuation:
+            yield punctuation, None
+        elif quote:
+            try:
+                value, pos = scanstring(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                # string is incomplete, rescan it once more data is read
+                pos = match.start()
+                safe_end = -1
+                continue
+            yield _VALUE, value
+        elif literal:
+            yield _VALUE, _LITERALS[literal]
+        elif frac or exp:
+            yield _VALUE, float(integer + (frac or '') + (exp or ''))
+        else:
+            yield _VALUE, int(integer)
+
+
+def _events(tokens):
+    """Turn JSON tokens to a flat stream of ``(event, value)`` pairs.
+
+    Events are `_START_MAP`, `_KEY`, `_END_MAP`, `_START_ARRAY`,
+    `_END_ARRAY` and `_VALUE`, in document order.
+    """
+    stack = []
+    token, value = tokens.next()
+    while True:
+        # `token` starts a value here
+        if token == '{':
+            yield _START_MAP, None
+            token, value = tokens.next()
+            if token != '}':
+                stack.append('{')
+                yield _KEY, _key(token, value, tokens)
+                token, value = tokens.next()
+                continue
+            yield _END_MAP, None
+        elif token == '[':
+            yield _START_ARRAY, None
+            token, value = tokens.next()
+            if token != ']':
+                stack.append('[')
+                continue
+            yield _END_ARRAY, None
+        elif token == _VALUE:
+            yield _VALUE, value
+        else:
+            raise ValueError("Expected JSON value, got %r" % (token if token != _EOF else 'end of file'))
+
+        # the value is complete, find out what goes next
+        while stack:
+            token, value = tokens.next()
+            if token == ',':
+                if stack[-1] == '{':
+                    token, value = tokens.next()
+                    yield _KEY, _key(token, value, tokens)
+                token, value = tokens.next()
+                break
+            elif token == '}' and stack[-1] == '{':
+                stack.pop()
+                yield _END_MAP, None
+            elif token == ']' and stack[-1] == '[':
+                stack.pop()
+                yield _END_ARRAY, None
+            else:
+                raise ValueError("Expected ',' or '%s' in JSON, got %r" %
+                                 ('}' if stack[-1] == '{' else ']', token))
+        else:
+            token, value = tokens.next()
+            if token != _EOF:
+                raise ValueError("Extra data after JSON document: %r" % token)
+            return
+
+
+def _key(token, value, tokens):
+    if token != _VALUE or not isinstance(value, basestring):
+        raise ValueError("Expected JSON object key, got %r" % token)
+    if tokens.next()[0] != ':':
+        raise ValueError("Expected ':' after JSON object key")
+    return value
+
+
+def _build(event, events):
+    """Load value starting with `event` from the rest of `events`"""
+    kind, value = event
+    if kind == _VALUE:
+        return value
+    # stack of (container, key of value being built) pairs
+    stack = []
+    while True:
+        if kind == _START_MAP:
+            stack.append(({}, None))
+        elif kind == _START_ARRAY:
+            stack.append(([], None))
+        elif kind == _KEY:
+            stack[-1] = (stack[-1][0], value)
+        else:
+            if kind in (_END_MAP, _END_ARRAY):
+                value = stack.pop()[0]
+                if not stack:
+                    return value
+            container, key = stack[-1]
+            if isinstance(container, list):
+                container.append(value)
+            else:
+                container[key] = value
+        kind, value = events.next()
+
+
+def _build_members(event, events):
+    """Load object members starting with `event` up to the end of object"""
+    members = {}
+    kind, key = event
+    while kind == _KEY:
+        members[key] = _build(events.next(), events)
+        kind, key = events.next()
+    return members
+
+
+def _skip_value(event, events):
+    """Skip a value starting with `event`"""
+    if event[0] == _VALUE:
+        return
+    depth = 1
+    for kind, value in events:
+        if kind in (_START_MAP, _START_ARRAY):
+            depth += 1
+        elif kind in (_END_MAP, _END_ARRAY):
+            depth -= 1
+            if not depth:
+                return
+
+
+def _skip_items(event, events):
+    """Skip the rest of an array starting with `event` which starts an item,
+    return how many items have been skipped"""
+    count = 1
+    depth = 1 if event[0] in (_START_MAP, _START_ARRAY) else 0
+    for kind, value in events:
+        if kind in (_START_MAP, _START_ARRAY):
+            if not depth:
+                count += 1
+            depth += 1
+        elif kind in (_END_MAP, _END_ARRAY):
+            if not depth:
+                return count
+            depth -= 1
+        elif kind == _VALUE and not depth:
+            count += 1
+
+
+def _summary(event):
+    kind, value = event
+    if kind == _START_MAP:
+        return '{...}'
+    if kind == _START_ARRAY:
+        return '[...]'
+    return _short_repr(value, _VALUE_LIMIT)[0]
+
+
+def _loaded_summary(value):
+    """Summary of a loaded value matching `_summary` of its events"""
+    if isinstance(value, dict):
+        return '{...}'
+    if isinstance(value, list):
+        return '[...]'
+    return _short_repr(value, _VALUE_LIMIT)[0]
+
+
+class _StreamComparison(_Comparison):
+    """Lockstep comparison of two JSON event streams.
+
+    Only an array or an object per nesting level is kept on the stack, values
+    are compared and dropped as they come.
+    """
+
+    def run(self, actual, expected):
+        # stack of [kind, path, next index] of arrays and objects being walked
+        stack = []
+        path = None
+        a = actual.next()
+        e = expected.next()
+        while True:
+            # both `a` and `e` start a value at `path` here
+            self.nodes += 1
+            if a[0] != e[0]:
+                self.add_diff(path, "expected %s, got %s" % (_summary(e), _summary(a)))
+                return
+            if a[0] == _VALUE:
+                if a[1] != e[1]:
+                    self.add_diff(path, "expected %s, got %s" % (_summary(e), _summary(a)))
+                    return
+            else:
+                stack.append([a[0], path, 0])
+
+            # find next pair of values to compare
+            while stack:
+                frame = stack[-1]
+                kind, parent, index = frame
+                a = actual.next()
+                e = expected.next()
+                if kind == _START_ARRAY:
+                    if a[0] == _END_ARRAY and e[0] == _END_ARRAY:
+                        stack.pop()
+                        continue
+                    if a[0] == _END_ARRAY or e[0] == _END_ARRAY:
+                        if a[0] == _END_ARRAY:
+                            actual_len, expected_len = index, index + _skip_items(e, expected)
+                        else:
+                            actual_len, expected_len = index + _skip_items(a, actual), index
+                        self.add_diff(parent, "expected length is %s, actual length is %s" %
+                                      (expected_len, actual_len))
+                        return
+                    frame[2] = index + 1
+                    path = (parent, index)
+                    break
+
+                if a[0] == _KEY and e[0] == _KEY and a[1] == e[1]:
+                    path = (parent, a[1])
+                    a = actual.next()
+                    e = expected.next()
+                    break
+                stack.pop()
+                if a[0] == _END_MAP and e[0] == _END_MAP:
+                    continue
+                # keys go in different order, compare the rest of the object
+                # regardless of the order
+                if self.compare_members(a, actual, _build_members(e, expected), parent):
+                    return
+            else:
+                return
+
+    def compare_members(self, a, actual, members, path):
+        """Compare the rest of object members in `actual` starting with event
+        `a` with loaded `members` of the object in `expected` at `path`.
+
+        Actual values are compared with loaded ones as they come, loaded
+        objects are looked up by keys, so the order of keys doesn't matter
+        at any depth. The object is consumed up to its end unless a
+        difference is found. Return whether it is.
+        """
+        # stack of [kind, path, loaded object members left or array, next index]
+        stack = [[_START_MAP, path, members, 0]]
+        while True:
+            # `a` is the next event of the innermost object or array
+            frame = stack[-1]
+            kind, parent, loaded, index = frame
+            if kind == _START_MAP:
+                if a[0] == _END_MAP:
+                    stack.pop()
+                    if loaded:
+                        return self.add_diff(parent, "expected keys %s are absent in actual" %
+                                             _short_repr(loaded.keys(), _VALUE_LIMIT)[0])
+                    if not stack:
+                        return False
+                    a = actual.next()
+                    continue
+                key = a[1]
+                if key not in loaded:
+                    _skip_value(actual.next(), actual)
+                    if self.ignore_extra_keys:
+                        a = actual.next()
+                        continue
+                    extra = [key]
+                    for _, key in iter(actual.next, (_END_MAP, None)):
+                        _skip_value(actual.next(), actual)
+                        if key not in loaded:
+                            extra.append(key)
+                    return self.add_diff(parent, "actual got unexpected keys %s" %
+                                         _short_repr(extra, _VALUE_LIMIT)[0])
+                path = (parent, key)
+                e = loaded.pop(key)
+                a = actual.next()
+            else:
+                if a[0] == _END_ARRAY or index == len(loaded):
+                    if a[0] != _END_ARRAY or index < len(loaded):
+                        actual_len = index + _skip_items(a, actual) if a[0] != _END_ARRAY else index
+                        return self.add_diff(parent, "expected length is %s, actual length is %s" %
+                                             (len(loaded), actual_len))
+                    stack.pop()
+                    a = actual.next()
+                    continue
+                frame[3] = index + 1
+                path = (parent, index)
+                e = loaded[index]
+
+            # `a` starts a value at `path` to compare with `e` here
+            self.nodes += 1
+            if a[0] == _START_MAP and isinstance(e, dict):
+                stack.append([_START_MAP, path, dict(e), 0])
+            elif a[0] == _START_ARRAY and isinstance(e, list):
+                stack.append([_START_ARRAY, path, e, 0])
+            elif a[0] != _VALUE or isinstance(e, (dict, list)) or a[1] != e:
+                return self.add_diff(path, "expected %s, got %s" % (_loaded_summary(e), _summary(a)))
+            a = actual.next()
@@ -0,0 +1,41 @@
+# -*- coding: utf-8; -*-
+
+"""
+Pytest plugin reporting the slowest testmania assertion call sites
+at the end of a session. It is not registered automatically, turn it on
+with::
+
+    py.test -p testmania.pytest_plugin
+
+See :py:mod:`testmania.instrument` for what is measured.
+"""
+
+from __future__ import absolute_import
+
+from testmania import instrument
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('testmania')
+    group.addoption('--testmania-slowest', type=int, default=10, metavar='N',
+                    help="number of the slowest testmania assertion call sites to report")
+
+
+def pytest_configure(config):
+    instrument.reset()
+    instrument.enable()
+
+
+def pytest_unconfigure(config):
+    instrument.disable()
+
+
+def pytest_terminal_summary(terminalreporter):
+    count = terminalreporter.config.getoption('testmania_slowest')
+    slowest = instrument.slowest(count)
+    if not slowest:
+        return
+    terminalreporter.write_sep('=', 'slowest %s testmania assertions' % len(slowest))
+    for stats in slowest:
+        terminalreporter.write_line('%10.4fs %7s calls %10s nodes %9s msg bytes  %s %s' % (
+            stats.time, stats.count, stats.nodes, stats.message_bytes, stats.name, stats.site))
@@ -2,7 +2,10 @@
 
 import datetime
 
+from testmania import instrument
 
+
+@instrument.instrumented('assert_just_now')
 def assert_just_now(time_value, msg=None, tolerance=1):
     """
     Test whether `time_value` represents almost current moment.
@@ -2,21 +2,52 @@
 
 from __future__ import absolute_import
 
+import collections
+import hashlib
 import itertools
-import xml.dom.minidom
+import multiprocessing
+import os
+import re
+import xml.etree.cElementTree as ElementTree
+import xml.parsers.expat
+from xml.sax.saxutils import escape, quoteattr
 
+from testmania import instrument
+from testmania.deep import _max_matching
 
+
+@instrument.instrumented('assert_xml_equal')
 def assert_xml_equal(actual, expected, msg=None, 
                      ignore_whitespace=True, 
                      ignore_extra_elements=False,
                      ignore_element_order=False,
                      ignore_list_order=False,
-                     ignore_extra_attrs=False):
+                     ignore_extra_attrs=False,
+                     max_message_size=4096,
+                     processes=1,
+                     split_level=1):
     """Test that two XMLs are equivalent.
 
     Provides detailed message if they don't match.
 
-    `actual` and `expected` should be strings with xmls to test.
+    `actual` and `expected` should be strings with xmls to test, file-like
+    objects or paths to files to read them from, or already parsed
+    :py:mod:`~xml.etree.ElementTree` elements or trees. Strings not
+    starting with ``<`` are taken as paths if such files exist, otherwise
+    they are parsed as they are, so that a garbage string fails to parse
+    rather than to open. Documents are parsed with expat into
+    :py:mod:`~xml.etree.ElementTree` elements, tag and attribute names are
+    compared as they are written, namespace prefixes included.
+    Comments and processing instructions are ignored. Trees given are
+    compared in place, without being copied or changed. Trees parsed by
+    :py:mod:`~xml.etree.ElementTree` have names of ``{uri}local`` form, so
+    if one of the documents is such a tree, the other one is parsed to
+    such names as well.
+
+    Parsed `expected` documents are cached, see
+    :py:func:`set_fixture_cache_size`. Trees given as `expected` are cached
+    too along with their hashes, so they should not be changed once
+    compared; pass a copy if a tree is changed and compared again.
 
     :param ignore_whitespace: whether insignificant whitespace should be ignored
     :param ignore_extra_elements: whether `actual` is allowed to have extra elements
@@ -29,40 +60,726 @@ def assert_xml_equal(actual, expected, msg=None,
         represent sets, not lists in your XML.
     :param ignore_extra_attrs: whether `actual` is allowed to have element attributes
         that aren't present in `expected`.
+    :param max_message_size: documents are printed in the failure message in
+        full only if they are small. Otherwise just a window around the
+        difference is printed: its ancestors with few siblings on every level
+        and the differing element. Each document takes about half of
+        `max_message_size` characters, whatever its size is.
+    :param processes: number of processes to compare documents in. If it's
+        greater than 1, elements at `split_level` depth, e.g. children of the
+        root element by default, are split into chunks compared in a process
+        pool. The difference reported is the same as in serial comparison.
+        Documents with less than a thousand elements on that level are still
+        compared serially, as well as on platforms without ``fork()``.
+    :param split_level: depth of elements to split among processes, the root
+        element is at depth 0.
     """
 
-    actual = xml.dom.minidom.parseString(actual)
-    expected = xml.dom.minidom.parseString(expected)
+    settings = _settings(ignore_extra_elements, ignore_element_order, ignore_list_order,
+                         ignore_extra_attrs, ignore_whitespace)
+    try:
+        _assert_documents_equal(actual, expected, msg, ignore_whitespace, max_message_size,
+                                settings, processes, split_level)
+    finally:
+        instrument.add_nodes(settings.nodes)
+
+
+def _assert_documents_equal(actual, expected, msg, ignore_whitespace, max_message_size,
+                            settings, processes=1, split_level=1):
+    if _is_tree(expected):
+        fixture = _load_tree_fixture(expected)
+        namespaces = not _is_tree(actual) and fixture.has_namespaces()
+    else:
+        namespaces = _is_tree(actual) and _has_namespaces(_load(actual, ignore_whitespace))
+        fixture = _load_fixture(expected, ignore_whitespace, namespaces)
+    actual = _load(actual, ignore_whitespace, namespaces)
+    expected = fixture.root
+
+    if processes > 1 and hasattr(os, 'fork'):
+        # hashing would take a serial walk over the whole actual document,
+        # leave it to the workers
+        mismatch = _probe_parallel(Twinode(actual, expected, settings), processes, split_level)
+    else:
+        # documents equal in canonical form are equal regardless of
+        # ignore_extra_* options, compare canonical hashes first
+        digest_key = (settings.ignore_whitespace, settings.ignore_element_order,
+                      settings.ignore_list_order)
+        expected_digest = fixture.digests.get(digest_key)
+        if expected_digest is None:
+            expected_digest = fixture.digests[digest_key] = _digest(expected, settings)
+        if _digest(actual, settings) == expected_digest:
+            return
+        mismatch = Twinode(actual, expected, settings).probe()
+    if mismatch is not None:
+        twinode, attr = mismatch
+        if not msg:
+            ancestors = []
+            while twinode.parent:
+                ancestors.append(twinode)
+                twinode = twinode.parent
+            ancestors.append(twinode)
+            ancestors.reverse()
+            # a node may be missing on one side, then its parent is printed
+            actual_chain = [t.actual for t in ancestors if t.actual is not None]
+            expected_chain = [t.expected for t in ancestors if t.expected is not None]
+            budget = max_message_size // 2
+            msg = u"\nExpected:\n%s\n\nActual:\n%s\n%s" % \
+                    (_format(expected, expected_chain, budget, ignore_whitespace),
+                     _format(actual, actual_chain, budget, ignore_whitespace),
+                     mismatch[0].describe(attr))
+        raise AssertionError(msg.encode('utf-8'))
+
+
+@instrument.instrumented('assert_xml_stream_equal')
+def assert_xml_stream_equal(actual, expected, msg=None,
+                            ignore_whitespace=True,
+                            ignore_extra_elements=False,
+                            ignore_element_order=False,
+                            ignore_list_order=False,
+                            ignore_extra_attrs=False):
+    """Test that two XML files are equivalent without loading them to memory.
+
+    `actual` and `expected` should be file-like objects opened for reading
+    or paths to files. Both documents are parsed incrementally and their
+    nodes are compared in lockstep as they come, so the comparison stops at
+    the first difference without reading the rest of the files. Memory used
+    depends on nesting depth of documents, not on their size.
+
+    Options have the same meaning as for :py:func:`assert_xml_equal` and
+    failure message tells the same path to the difference. However
+    `ignore_extra_elements`, `ignore_element_order` and `ignore_list_order`
+    need all children of an element at once to match them, so if any of
+    them is set both documents are loaded to memory first.
+    """
+    actual_file = _open(actual)
+    try:
+        expected_file = _open(expected)
+        try:
+            try:
+                if ignore_extra_elements or ignore_element_order or ignore_list_order:
+                    settings = _settings(ignore_extra_elements, ignore_element_order,
+                                         ignore_list_order, ignore_extra_attrs,
+                                         ignore_whitespace)
+                    actual_root = _parse(actual_file, strip=ignore_whitespace)
+                    expected_root = _parse(expected_file, strip=ignore_whitespace)
+                    try:
+                        Twinode(actual_root, expected_root, settings).assert_equal()
+                    finally:
+                        instrument.add_nodes(settings.nodes)
+                else:
+                    _compare_streams(_stream_events(actual_file, ignore_whitespace),
+                                     _stream_events(expected_file, ignore_whitespace),
+                                     ignore_extra_attrs)
+            except AssertionError, e:
+                raise AssertionError(msg or unicode(e).encode('utf-8'))
+        finally:
+            if expected_file is not expected:
+                expected_file.close()
+    finally:
+        if actual_file is not actual:
+            actual_file.close()
+
+
+def _open(source):
+    if hasattr(source, 'read'):
+        return source
+    return open(source, 'rb')
+
+
+class _LRUCache(object):
+    """Mapping of limited size dropping least recently used items"""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = collections.OrderedDict()
+
+    def get(self, key):
+        value = self.items.pop(key, None)
+        if value is not None:
+            self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        self.trim()
+
+    def trim(self):
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+
+class _Fixture(object):
+    """Parsed expected document along with its canonical hashes"""
+
+    __slots__ = ('root', 'digests', 'namespaces')
+
+    def __init__(self, root):
+        self.root = root
+        # maps (ignore_whitespace, ignore_element_order, ignore_list_order)
+        # to hash of root
+        self.digests = {}
+        self.namespaces = None
+
+    def has_namespaces(self):
+        if self.namespaces is None:
+            self.namespaces = _has_namespaces(self.root)
+        return self.namespaces
+
+
+# parsed expected documents by hashes of their content
+_fixture_cache = _LRUCache(16)
+
+
+def set_fixture_cache_size(size):
+    """Set how many parsed `expected` documents :py:func:`assert_xml_equal`
+    keeps to avoid parsing them again, 16 by default. Documents are looked
+    up by hash of their content, whether they are given as strings, files or
+    paths. Trees given as `expected` are looked up by identity. 0 turns
+    caching off."""
+    _fixture_cache.size = size
+    _fixture_cache.trim()
+
+
+def _load_fixture(source, ignore_whitespace, namespaces=False):
+    data = _read(source)
+    key = (hashlib.md5(data).digest(), ignore_whitespace, namespaces)
+    fixture = _fixture_cache.get(key)
+    if fixture is None:
+        fixture = _Fixture(_load(data, ignore_whitespace, namespaces))
+        _fixture_cache.put(key, fixture)
+    return fixture
+
+
+def _load_tree_fixture(source):
+    root = source.getroot() if hasattr(source, 'getroot') else source
+    # the fixture refers to the root, so its id isn't reused while cached
+    key = ('tree', id(root))
+    fixture = _fixture_cache.get(key)
+    if fixture is None:
+        fixture = _Fixture(root)
+        _fixture_cache.put(key, fixture)
+    return fixture
+
+
+def _load(source, ignore_whitespace, namespaces=False):
+    """Return root element of a document given as a string, a file-like
+    object, a path or an element tree. Trees given are returned as they are,
+    whitespace-only texts in them are skipped as they are walked."""
+    if hasattr(source, 'getroot'):
+        return source.getroot()
+    if ElementTree.iselement(source):
+        return source
+
+    return _parse(_read(source), strip=ignore_whitespace, namespaces=namespaces)
+
+
+def _is_tree(source):
+    return ElementTree.iselement(source) or hasattr(source, 'getroot')
+
+
+def _has_namespaces(root):
+    """Whether tags or attribute names of `root` tree are of ``{uri}local``
+    form"""
+    for element in root.iter():
+        if element.tag[:1] == '{' or any(name[:1] == '{' for name in element.attrib):
+            return True
+    return False
 
-    if ignore_whitespace:
-        _strip_whitespace(actual)
-        _strip_whitespace(expected)
 
+# optional byte order mark, either encoded or not, and whitespace before a tag
+_XML_START_RE = re.compile(u'(?:\xef\xbb\xbf|\ufeff)?\\s*<')
+
+
+def _read(source):
+    """Return XML bytes of a string, a file-like object or a path to a file"""
+    if hasattr(source, 'read'):
+        data = source.read()
+    elif not _XML_START_RE.match(source) and _is_file(source):
+        with open(source, 'rb') as f:
+            data = f.read()
+    else:
+        data = source
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    return data
+
+
+def _is_file(path):
+    try:
+        return os.path.isfile(path)
+    except (TypeError, ValueError):
+        # NUL or characters the file system encoding lacks
+        return False
+
+
+def _settings(ignore_extra_elements, ignore_element_order, ignore_list_order,
+              ignore_extra_attrs, ignore_whitespace=False):
     settings = Settings()
+    settings.ignore_whitespace = ignore_whitespace
     settings.ignore_extra_elements = ignore_extra_elements
     settings.ignore_element_order = ignore_element_order
     settings.ignore_list_order = ignore_list_order
     settings.ignore_extra_attrs = ignore_extra_attrs
-    twiroot = Twinode(actual.documentElement, expected.documentElement, settings)
-
+    # number of nodes visited
+    settings.nodes = 0
+    # digests of subtrees by ids of their roots
+    settings.digests = {}
+    # same, but of subtrees without attributes
+    settings.bare_digests = {}
+    # results of pairwise matching by ids of nodes of pairs
+    settings.equal_pairs = {}
+    return settings
+
+
+# fewer pairs at the split level are compared serially, since starting
+# a pool would take longer
+_PARALLEL_MIN_PAIRS = 1000
+# chunks per process, more chunks balance load better
+_PARALLEL_CHUNKS = 4
+# pairs being compared in parallel, inherited by forked workers
+_parallel_pairs = None
+
+
+def _split(root, level):
+    """Compare pairs of nodes above `level` depth in document order up to
+    the first difference. Return list of pairs at `level` met before it
+    and the difference or None."""
+    pairs = []
+    stack = [iter([root])]
+    while stack:
+        twinode = next(stack[-1], None)
+        if twinode is None:
+            stack.pop()
+            continue
+        if len(stack) > level:
+            pairs.append(twinode)
+            continue
+        mismatch = twinode.probe_node()
+        if mismatch is not None:
+            return pairs, mismatch
+        if not _is_text(twinode.actual):
+            stack.append(itertools.imap(twinode.create_child, twinode.arrange_children()))
+    return pairs, None
+
+
+def _probe_parallel(root, processes, level):
+    """Probe `root` as :py:meth:`Twinode.probe` does, comparing pairs at
+    `level` depth in a pool of `processes`"""
+    global _parallel_pairs
+    pairs, mismatch = _split(root, level)
+    if len(pairs) < _PARALLEL_MIN_PAIRS:
+        for twinode in pairs:
+            pair_mismatch = twinode.probe()
+            if pair_mismatch is not None:
+                return pair_mismatch
+        return mismatch
+
+    size = -(-len(pairs) // (processes * _PARALLEL_CHUNKS))
+    chunks = [(start, min(start + size, len(pairs))) for start in xrange(0, len(pairs), size)]
+    _parallel_pairs = pairs
+    pool = multiprocessing.Pool(processes)
     try:
-        twiroot.assert_equal()
-    except AssertionError, e:
-        if not msg:
-            msg = u"\nExpected:\n%s\n\nActual:\n%s\n%s" % \
-                    (expected.toprettyxml(), actual.toprettyxml(), e)
-        raise AssertionError(msg.encode('utf-8'))
+        # results come in order of chunks, so the first difference found
+        # is the first one in document order
+        for index, nodes in pool.imap(_probe_chunk, chunks):
+            root.settings.nodes += nodes
+            if index is not None:
+                # probe the pair again here to get the difference linked
+                # to its ancestors
+                return pairs[index].probe()
+    finally:
+        pool.terminate()
+        pool.join()
+        _parallel_pairs = None
+    # pairs at `level` precede the difference found above it, if any
+    return mismatch
+
+
+def _probe_chunk(bounds):
+    """Probe pairs from `bounds` range in a worker, return index of the
+    first different pair or None and number of nodes visited"""
+    start, stop = bounds
+    settings = _parallel_pairs[start].settings
+    visited = settings.nodes
+    for index in xrange(start, stop):
+        if _parallel_pairs[index].probe() is not None:
+            return index, settings.nodes - visited
+    return None, settings.nodes - visited
+
+
+_START = 'start'
+_TEXT = 'text'
+_END = 'end'
+_CHUNK_SIZE = 64 * 1024
+
+
+def _stream_events(fileobj, strip):
+    """Parse XML file chunk by chunk, yield ``(event, value)`` pairs.
+
+    Events are `_START` with ``(tag, attributes)`` value, `_TEXT` with text
+    between tags, and `_END` with a tag. Texts are stripped and empty ones are
+    skipped if `strip` is true.
+    """
+    events = []
+    texts = []
+
+    def flush():
+        text = u''.join(texts)
+        del texts[:]
+        if strip:
+            text = text.strip()
+            if not text:
+                return
+        events.append((_TEXT, text))
+
+    def start(tag, attrs):
+        if texts:
+            flush()
+        events.append((_START, (tag, attrs)))
+
+    def end(tag):
+        if texts:
+            flush()
+        events.append((_END, tag))
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = texts.append
+    while True:
+        data = fileobj.read(_CHUNK_SIZE)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        parser.Parse(data, not data)
+        for event in events:
+            yield event
+        del events[:]
+        if not data:
+            return
+
+
+def _format_event(event):
+    if event is None or event[0] == _END:
+        return 'nothing'
+    kind, value = event
+    if kind == _TEXT:
+        return '"%s"' % value.strip()
+    return '<%s> element' % value[0]
+
+
+def _compare_streams(actual, expected, ignore_extra_attrs):
+    """Compare two streams of events as :py:class:`Twinode` would compare
+    trees built of them, raise `AssertionError` at the first difference"""
+    # tags of elements being compared, the root first
+    stack = []
+    nodes = 0
+    try:
+        while True:
+            a = next(actual, None)
+            e = next(expected, None)
+            if a is None and e is None:
+                return
+            nodes += 1
+            if a is None or e is None or a[0] != e[0]:
+                raise AssertionError("at %s expected %s, got %s" % (
+                    '/'.join([''] + stack) or '/', _format_event(e), _format_event(a)))
+
+            kind = a[0]
+            if kind == _START:
+                actual_tag, actual_attrs = a[1]
+                expected_tag, expected_attrs = e[1]
+                if actual_tag != expected_tag:
+                    raise AssertionError("at %s expected %s, got %s" % (
+                        '/'.join([''] + stack) or '/', _format_event(e), _format_event(a)))
+                for key, value in actual_attrs.iteritems():
+                    if key in expected_attrs:
+                        if expected_attrs[key] != value:
+                            _raise_stream_attr(stack, actual_tag, key, actual_attrs, expected_attrs)
+                    elif not ignore_extra_attrs:
+                        _raise_stream_attr(stack, actual_tag, key, actual_attrs, expected_attrs)
+                for key in expected_attrs:
+                    if key not in actual_attrs:
+                        _raise_stream_attr(stack, actual_tag, key, actual_attrs, expected_attrs)
+                stack.append(actual_tag)
+            elif kind == _TEXT:
+                if a[1].strip() != e[1].strip():
+                    raise AssertionError("at %s expected %s, got %s" % (
+                        '/'.join([''] + stack) or '/', _format_event(e), _format_event(a)))
+            else:
+                stack.pop()
+    finally:
+        instrument.add_nodes(nodes)
+
+
+def _raise_stream_attr(stack, tag, attr, actual_attrs, expected_attrs):
+    format_attr = lambda attrs: '"%s"' % attrs[attr] if attr in attrs else 'nothing'
+    raise AssertionError("at %s@%s expected %s, got %s" % (
+        '/'.join([''] + stack + [tag]), attr,
+        format_attr(expected_attrs), format_attr(actual_attrs)))
+
+
+def _parse(source, strip=False, namespaces=False):
+    """Parse XML string or file to an element tree, return the root element.
+
+    Expat is used directly instead of :py:class:`~xml.etree.ElementTree.XMLParser`
+    to keep qualified names as they are, e.g. ``soap:Envelope``, rather than
+    turn them to ``{uri}Envelope``. Parser callbacks are methods of C
+    tree builder, so no Python code runs per node unless `strip` or
+    `namespaces` is set.
+
+    If `strip` is set, texts are stripped of whitespace as they are parsed
+    and whitespace-only ones are dropped. Expat may pass a text in pieces,
+    so they are collected until the next tag, as :py:func:`_stream_events`
+    does.
+
+    If `namespaces` is set, names are resolved to ``{uri}local`` form and
+    namespace declarations are dropped from attributes, as
+    :py:mod:`~xml.etree.ElementTree` parsers do.
+    """
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    builder = ElementTree.TreeBuilder()
+    start_element, end_element = builder.start, builder.end
+    if namespaces:
+        # expat joins namespace URI and local name with the separator
+        parser = xml.parsers.expat.ParserCreate(namespace_separator='}')
+
+        def start_element(tag, attrs):
+            builder.start(_clark(tag),
+                          dict((_clark(name), value) for name, value in attrs.iteritems()))
+
+        def end_element(tag):
+            builder.end(_clark(tag))
+    else:
+        parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
+    if strip:
+        texts = []
+
+        def flush():
+            text = u''.join(texts).strip()
+            del texts[:]
+            if text:
+                builder.data(text)
+
+        def start(tag, attrs):
+            if texts:
+                flush()
+            start_element(tag, attrs)
+
+        def end(tag):
+            if texts:
+                flush()
+            end_element(tag)
+
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = texts.append
+    else:
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+        parser.CharacterDataHandler = builder.data
+    if hasattr(source, 'read'):
+        parser.ParseFile(source)
+    else:
+        parser.Parse(source, True)
+    return builder.close()
+
+
+def _clark(name):
+    """Turn ``uri}local`` name passed by expat to ``{uri}local``"""
+    return '{' + name if '}' in name else name
+
+
+def _is_node(text, strip):
+    """Whether `text` of a tree is a node, whitespace-only texts are not
+    if `strip` is set, as if they were dropped by :py:func:`_parse`"""
+    if text is None:
+        return False
+    return not strip or (text and not text.isspace())
+
+
+def _child_nodes(element, strip=False):
+    """Return children of `element` with texts between them, texts are
+    strings"""
+    nodes = []
+    if _is_node(element.text, strip):
+        nodes.append(element.text)
+    for child in element:
+        nodes.append(child)
+        if _is_node(child.tail, strip):
+            nodes.append(child.tail)
+    return nodes
+
+
+def _digest(node, settings, attrs=True):
+    """Return hash of `node` subtree which is the same for subtrees equal
+    with `settings`, ignoring `ignore_extra_*` options. It is computed from
+    canonical form of the subtree: attributes are sorted, and children are
+    sorted as far as element and list order are ignored. Hashes of all
+    elements of the subtree are stored in `settings.digests`.
+
+    If `attrs` is false, attributes are left out, so that the hash is the
+    same for subtrees that differ in attributes only. Such hashes are
+    stored in `settings.bare_digests`."""
+    digests = settings.digests if attrs else settings.bare_digests
+    if _is_text(node):
+        return _token('t', node.strip())
+    if id(node) in digests:
+        return digests[id(node)]
+
+    # post-order walk
+    stack = [(node, False)]
+    while stack:
+        element, children_done = stack.pop()
+        if not children_done:
+            stack.append((element, True))
+            stack.extend((child, False) for child in element if id(child) not in digests)
+            continue
+
+        tokens = [(_tag_key(n), _token('t', n.strip()) if _is_text(n) else 'e' + digests[id(n)])
+                  for n in _child_nodes(element, settings.ignore_whitespace)]
+        if settings.ignore_element_order:
+            tokens.sort(key=lambda token: token[0])
+        parts = [_token('g', element.tag)]
+        if attrs:
+            parts.extend(sorted(_token('a', name) + _token('v', value)
+                                for name, value in element.attrib.iteritems()))
+        if settings.ignore_list_order:
+            for key, group in itertools.groupby(tokens, key=lambda token: token[0]):
+                group = [token for _, token in group]
+                if key != '!text':
+                    group.sort()
+                parts.extend(group)
+        else:
+            parts.extend(token for _, token in tokens)
+        settings.nodes += 1
+        digests[id(element)] = hashlib.md5(u''.join(parts).encode('utf-8')).hexdigest()
+
+    return digests[id(node)]
 
 
-def _strip_whitespace(node):
-    for n in node.childNodes[:]:
-        if n.nodeType == xml.dom.Node.TEXT_NODE:
-            n.data = n.data.strip()
-            if not n.data:
-                node.removeChild(n)
-                n.unlink()
-        elif n.nodeType == xml.dom.Node.ELEMENT_NODE:
-            _strip_whitespace(n)
+def _token(kind, value):
+    """Return part of canonical form of a subtree, prefixed with its
+    length so that no sequence of parts reads as another one"""
+    return u'%s%d:%s' % (kind, len(value), value)
+
+
+def _is_text(node):
+    return isinstance(node, basestring)
+
+
+def _tag_key(node):
+    return '!text' if _is_text(node) else node.tag
+
+
+# siblings printed around each ancestor of a difference
+_WINDOW_SIBLINGS = 2
+# ancestors printed above a difference
+_WINDOW_DEPTH = 8
+
+
+def _iter_child_nodes(element, strip=False):
+    if _is_node(element.text, strip):
+        yield element.text
+    for child in element:
+        yield child
+        if _is_node(child.tail, strip):
+            yield child.tail
+
+
+def _start_tag(element):
+    return element.tag + ''.join(' %s=%s' % (name, quoteattr(value))
+                                 for name, value in sorted(element.attrib.items()))
+
+
+def _render(node, indent, limit, strip=False):
+    """Format `node` subtree indenting each level with a tab. Return list of
+    lines and whether they were cut after about `limit` characters; only
+    as much of the subtree is visited as is printed. Whitespace-only texts
+    are skipped if `strip` is set."""
+    lines = []
+    size = 0
+    # iterators over children of elements being printed with their indents
+    stack = [(iter([node]), indent, None)]
+    while stack:
+        children, indent, tag = stack[-1]
+        child = next(children, None)
+        if child is None:
+            stack.pop()
+            if tag is None:
+                continue
+            line = '%s</%s>' % (indent[:-1], tag)
+        elif _is_text(child):
+            line = indent + escape(child.strip())
+        elif len(child) or _is_node(child.text, strip):
+            line = '%s<%s>' % (indent, _start_tag(child))
+            stack.append((_iter_child_nodes(child, strip), indent + '\t', child.tag))
+        else:
+            line = '%s<%s/>' % (indent, _start_tag(child))
+        size += len(line) + 1
+        if size > limit:
+            lines.append(indent + '...')
+            return lines, True
+        lines.append(line)
+    return lines, False
+
+
+def _format(root, chain, budget, strip=False):
+    """Format document with `root` element in full if it fits in `budget`
+    characters, otherwise only a window around the last node of `chain`,
+    which is a list of nodes from `root` down to a differing one"""
+    lines, cut = _render(root, '', budget, strip)
+    if cut:
+        lines = _format_window(chain, budget, strip)
+    return '\n'.join(lines) + '\n'
+
+
+def _format_window(chain, budget, strip=False):
+    """Format ancestors from `chain` along with few siblings on every level
+    and the node `chain` ends with. Siblings are walked without being
+    listed and only few of them are rendered, so cost depends on depth of
+    the node and width of levels above it, not on size of the document."""
+    lines = []
+    skip = max(0, len(chain) - 1 - _WINDOW_DEPTH)
+    if skip:
+        lines.append('...%s levels up...' % skip)
+    sibling_limit = max(80, budget // (4 * _WINDOW_SIBLINGS * (len(chain) - skip)))
+    # closing parts of ancestors, the innermost last
+    closings = []
+    for depth, (parent, node) in enumerate(zip(chain[skip:], chain[skip + 1:])):
+        indent = '\t' * depth
+        inner = indent + '\t'
+        lines.append('%s<%s>' % (indent, _start_tag(parent)))
+        siblings = _iter_child_nodes(parent, strip)
+        # siblings just before the node
+        preceding = collections.deque(maxlen=_WINDOW_SIBLINGS)
+        skipped = 0
+        for sibling in siblings:
+            if sibling is node:
+                break
+            if len(preceding) == _WINDOW_SIBLINGS:
+                skipped += 1
+            preceding.append(sibling)
+        if skipped:
+            lines.append('%s...%s nodes...' % (inner, skipped))
+        for sibling in preceding:
+            lines.extend(_render(sibling, inner, sibling_limit, strip)[0])
+        closing = []
+        for sibling in itertools.islice(siblings, _WINDOW_SIBLINGS):
+            closing.extend(_render(sibling, inner, sibling_limit, strip)[0])
+        skipped = sum(1 for _ in siblings)
+        if skipped:
+            closing.append('%s...%s nodes...' % (inner, skipped))
+        closing.append('%s</%s>' % (indent, parent.tag))
+        closings.append(closing)
+
+    lines.extend(_render(chain[-1], '\t' * (len(chain) - 1 - skip), budget // 4, strip)[0])
+    for closing in reversed(closings):
+        lines.extend(closing)
+    return lines
 
 
 class Settings(object):
@@ -70,6 +787,14 @@ class Settings(object):
 
 
 class Twinode(object):
+    """Pair of nodes at the same place of `actual` and `expected` documents.
+
+    Pairs are light: they hold the nodes and the parent pair only, and pairs
+    of children are made one by one as the walk reaches them, so that none
+    are made past the first difference.
+    """
+    __slots__ = ('actual', 'expected', 'settings', 'parent')
+
     def __init__(self, actual, expected, settings, parent=None):
         self.actual = actual
         self.expected = expected
@@ -77,130 +802,219 @@ class Twinode(object):
         self.parent = parent
 
     def assert_equal(self):
+        mismatch = self.probe()
+        if mismatch is not None:
+            twinode, attr = mismatch
+            raise AssertionError(twinode.describe(attr))
+
+    def probe(self):
+        """Compare subtrees without raising. Return None if they are equal,
+        otherwise ``(twinode, attr)`` pair telling where the first difference
+        is, `attr` is None unless it's a difference of attributes.
+
+        Nothing is formatted here, the message is built by :py:meth:`describe`
+        for the difference that is finally reported only.
+        """
+        mismatch = self.probe_node()
+        if mismatch is not None or _is_text(self.actual):
+            return mismatch
+
+        # depth-first walk, every level being compared keeps an iterator
+        # of pairs of its children left
+        stack = [(self, self.arrange_children())]
+        while stack:
+            parent, pairs = stack[-1]
+            pair = next(pairs, None)
+            if pair is None:
+                stack.pop()
+                continue
+            twinode = parent.create_child(pair)
+            mismatch = twinode.probe_node()
+            if mismatch is not None:
+                return mismatch
+            if not _is_text(twinode.actual):
+                stack.append((twinode, twinode.arrange_children()))
+        return None
+
+    def probe_node(self):
+        """Compare nodes of the pair but not their children"""
+        self.settings.nodes += 1
         if self.actual is None or self.expected is None:
-            self._raise()
-
-        if self.actual.nodeType != self.expected.nodeType:
-            self._raise()
-
-        node_type = self.actual.nodeType
-        if node_type == xml.dom.Node.TEXT_NODE:
-            self.assert_equal_text()
-        elif node_type == xml.dom.Node.ELEMENT_NODE:
-            self.assert_equal_elements()
-        else:
-            raise NotImplementedError("Comparison of %s nodes is not implemented" % node_type)
-
-        self.arrange_children()
-        for twinode in self.children:
-            twinode.assert_equal()
-
-    def assert_equal_text(self):
-        actual_str = self.actual.data.strip()
-        expected_str = self.expected.data.strip()
-        if actual_str != expected_str:
-            self._raise()
-
-    def assert_equal_elements(self):
-        if self.actual.tagName != self.expected.tagName:
-            self._raise()
-
-        for key, value in self.actual.attributes.items():
-            try:
-                if self.expected.attributes[key].value != value:
-                    self._raise_attr(key)
-            except KeyError:
-                if not self.settings.ignore_extra_attrs:
-                    self._raise_attr(key)
-
-        for key in self.expected.attributes.keys():
-            if not self.actual.hasAttribute(key):
-                self._raise_attr(key)
-
-    def _raise(self):
-        msg = "at %s expected %s, got %s" % \
+            return self, None
+
+        if _is_text(self.actual) != _is_text(self.expected):
+            return self, None
+
+        if _is_text(self.actual):
+            return self.probe_text()
+        return self.probe_elements()
+
+    def probe_text(self):
+        # texts of trees given are not stripped on loading
+        if self.actual.strip() != self.expected.strip():
+            return self, None
+        return None
+
+    def probe_elements(self):
+        if self.actual.tag != self.expected.tag:
+            return self, None
+
+        expected_attrs = self.expected.attrib
+        for key, value in self.actual.attrib.iteritems():
+            if key in expected_attrs:
+                if expected_attrs[key] != value:
+                    return self, key
+            elif not self.settings.ignore_extra_attrs:
+                return self, key
+
+        for key in expected_attrs:
+            if key not in self.actual.attrib:
+                return self, key
+        return None
+
+    def describe(self, attr=None):
+        """Format message about difference of nodes or of their `attr`"""
+        if attr is None:
+            return "at %s expected %s, got %s" % \
                 (self.path(), self.format_node(self.expected), self.format_node(self.actual))
-        raise AssertionError(msg)
-
-    def _raise_attr(self, attr):
-        msg = "at %s expected %s, got %s" % \
-                (self.path_to_attr(attr), self.format_attr(self.expected, attr), self.format_attr(self.actual, attr))
-        raise AssertionError(msg)
+        return "at %s expected %s, got %s" % \
+            (self.path_to_attr(attr), self.format_attr(self.expected, attr), self.format_attr(self.actual, attr))
 
     def path(self, root_symbol='/'):
-        if not self.parent:
+        if self.parent is None:
             return root_symbol
-        return '%s/%s' % (self.parent.path(root_symbol=''), 
-                          (self.actual or self.expected).parentNode.tagName)
+        # children are compared only when tags of parents are equal
+        tags = []
+        twinode = self.parent
+        while twinode is not None:
+            tags.append(twinode.actual.tag)
+            twinode = twinode.parent
+        tags.reverse()
+        return '/' + '/'.join(tags)
 
     def path_to_attr(self, attr):
-        return '%s/%s@%s' % (self.path(root_symbol=''), self.actual.tagName, attr)
+        return '%s/%s@%s' % (self.path(root_symbol=''), self.actual.tag, attr)
 
     def format_node(self, node):
         if node is None:
             return 'nothing'
-        if node.nodeType == xml.dom.Node.TEXT_NODE:
-            return '"%s"' % node.data.strip()
-        if node.nodeType == xml.dom.Node.ELEMENT_NODE:
-            return '<%s> element' % node.tagName
-        return repr(node)
-    
+        if _is_text(node):
+            return '"%s"' % node.strip()
+        return '<%s> element' % node.tag
+
     def format_attr(self, node, attr):
         try:
-            return '"%s"' % node.attributes[attr].value
+            return '"%s"' % node.attrib[attr]
         except KeyError:
             return 'nothing'
 
     def arrange_children(self):
-        actual_children = self.actual.childNodes
-        expected_children = self.expected.childNodes
-
-        expected_child_tags = [
-            n.tagName for n in self.expected.childNodes
-            if n.nodeType == xml.dom.Node.ELEMENT_NODE]
+        """Return iterator of ``(actual, expected)`` pairs of child nodes to
+        compare, a node is None where the other one has no pair. Children
+        are paired as the iterator is consumed, except that they have to be
+        listed first if element order is ignored."""
+        strip = self.settings.ignore_whitespace
+        actual_children = _iter_child_nodes(self.actual, strip)
+        expected_children = _iter_child_nodes(self.expected, strip)
 
         if self.settings.ignore_extra_elements:
-            actual_children = [c for c in actual_children 
-                               if c.nodeType != xml.dom.Node.ELEMENT_NODE or 
-                               c.tagName in expected_child_tags]
-
-        tag_key = lambda node: node.tagName if node.nodeType == xml.dom.Node.ELEMENT_NODE else '!text'
+            expected_child_tags = set(child.tag for child in self.expected)
+            actual_children = (c for c in actual_children
+                               if _is_text(c) or c.tag in expected_child_tags)
 
         if self.settings.ignore_element_order:
-            actual_children = sorted(actual_children, key=tag_key)
-            expected_children = sorted(expected_children, key=tag_key)
+            actual_children = sorted(actual_children, key=_tag_key)
+            expected_children = sorted(expected_children, key=_tag_key)
 
         if self.settings.ignore_list_order:
-            actual_children_groups = itertools.groupby(actual_children, key=tag_key)
-            expected_children_groups = itertools.groupby(expected_children, key=tag_key)
-            group_pairs = itertools.izip_longest(actual_children_groups, expected_children_groups)
-            actual_children = []
-            expected_children = []
-            for (actual_tag, actual_nodes), (expected_tag, expected_nodes) in group_pairs:
-                if actual_tag != expected_tag or actual_tag == '!text':
-                    actual_children.extend(actual_nodes)
-                    expected_children.extend(expected_nodes)
-                    continue
-                # we've got two element lists: actual_nodes and expected_nodes
-                # check all combinations and add those that match at the beginning
-                matches = filter(self.are_equal, itertools.product(actual_nodes, expected_nodes))
-                actual_matched = [n for n, _ in matches]
-                expected_matched = [n for _, n in matches]
-                actual_not_matched = [n for n in actual_nodes if n not in actual_matched]
-                expected_not_matched = [n for n in expected_nodes if n not in expected_matched]
-                actual_children.extend(actual_matched + actual_not_matched)
-                expected_children.extend(expected_matched + expected_not_matched)
-
-        self.children = map(self.create_child, itertools.izip_longest(actual_children, expected_children))
+            return self.pair_groups(actual_children, expected_children)
+        return itertools.izip_longest(actual_children, expected_children)
+
+    def pair_groups(self, actual_children, expected_children):
+        """Generate pairs of children, recurring elements are matched to
+        each other regardless of order one group at a time"""
+        actual_children_groups = ((tag, list(nodes)) for tag, nodes in
+                                  itertools.groupby(actual_children, key=_tag_key))
+        expected_children_groups = ((tag, list(nodes)) for tag, nodes in
+                                    itertools.groupby(expected_children, key=_tag_key))
+        group_pairs = itertools.izip_longest(actual_children_groups, expected_children_groups,
+                                             fillvalue=(None, []))
+        for (actual_tag, actual_nodes), (expected_tag, expected_nodes) in group_pairs:
+            if actual_tag != expected_tag or actual_tag == '!text':
+                for pair in itertools.izip_longest(actual_nodes, expected_nodes):
+                    yield pair
+                continue
+            # we've got two element lists: actual_nodes and expected_nodes,
+            # pairs that match are equal and needn't be compared again, the
+            # rest are compared positionally to report a difference
+            actual_rest, expected_rest = self.match_nodes(actual_nodes, expected_nodes)
+            for pair in itertools.izip_longest(actual_rest, expected_rest):
+                yield pair
+
+    def match_nodes(self, actual_nodes, expected_nodes):
+        """Match `actual_nodes` to equal `expected_nodes` one to one, return
+        lists of nodes left without a match.
+
+        If options make equality symmetric, nodes are matched by lookup of
+        their digests. Otherwise, e.g. if extra attributes or elements in
+        `actual` are ignored, nodes are put to buckets by a coarser key
+        that equal nodes share, see :py:meth:`loose_key`, and expected nodes
+        are matched to actual ones in their buckets so that as many of them
+        as possible find a match.
+        """
+        if self.settings.ignore_extra_attrs or self.settings.ignore_extra_elements:
+            buckets = {}
+            for i, actual in enumerate(actual_nodes):
+                buckets.setdefault(self.loose_key(actual), []).append(i)
+            candidates = [buckets.get(self.loose_key(expected), ()) for expected in expected_nodes]
+            owners = _max_matching(candidates, lambda e, a: self.are_equal((actual_nodes[a],
+                                                                             expected_nodes[e])))
+            matched = set(owners.itervalues())
+            actual_rest = [n for i, n in enumerate(actual_nodes) if i not in owners]
+            expected_rest = [n for i, n in enumerate(expected_nodes) if i not in matched]
+            return actual_rest, expected_rest
+
+        buckets = {}
+        for actual in actual_nodes:
+            buckets.setdefault(self.digest(actual), collections.deque()).append(actual)
+        expected_rest = []
+        for expected in expected_nodes:
+            bucket = buckets.get(self.digest(expected))
+            if bucket:
+                bucket.popleft()
+            else:
+                expected_rest.append(expected)
+        left = set(id(n) for bucket in buckets.itervalues() for n in bucket)
+        actual_rest = [n for n in actual_nodes if id(n) in left]
+        return actual_rest, expected_rest
+
+    def digest(self, node):
+        return _digest(node, self.settings)
+
+    def loose_key(self, element):
+        """Return key which is the same for `element` of `actual` and an
+        element of `expected` it is equal to with `ignore_extra_*` options.
+        Extra elements may be anywhere in the subtree, so if they are
+        ignored, just the element itself and its texts are keyed, which
+        are kept as they are. Otherwise the key is the hash of the subtree
+        without attributes if extra ones are ignored."""
+        if self.settings.ignore_extra_elements:
+            attrs = () if self.settings.ignore_extra_attrs else tuple(sorted(element.attrib.items()))
+            texts = tuple(node.strip() for node in
+                          _iter_child_nodes(element, self.settings.ignore_whitespace)
+                          if _is_text(node))
+            return element.tag, attrs, texts
+        return _digest(element, self.settings, attrs=False)
 
     def create_child(self, pair):
         actual, expected = pair
         return Twinode(actual, expected, settings=self.settings, parent=self)
 
     def are_equal(self, pair):
-        try:
-            self.create_child(pair).assert_equal()
-        except AssertionError:
-            return False
-        else:
-            return True
+        # a pair left unmatched is probed again positionally, which would
+        # match its children pairwise again, and so on down the subtree
+        key = (id(pair[0]), id(pair[1]))
+        equal = self.settings.equal_pairs.get(key)
+        if equal is None:
+            equal = self.settings.equal_pairs[key] = self.create_child(pair).probe() is None
+        return equal
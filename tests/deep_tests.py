@@ -1,7 +1,16 @@
 # -*- coding: utf-8; -*-
 
-from testmania.pep8 import assert_equal, assert_raises, assert_raises_regexp
-from testmania.deep import assert_deep_equal
+import collections
+from unittest import SkipTest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from testmania.pep8 import assert_equal, assert_raises, assert_raises_regexp, assert_in, assert_not_in, assert_less
+from testmania.deep import assert_deep_equal, Fingerprint, compile as compile_expected, _max_matching
+from testmania.expect import Expectation
 
 
 class TestDeepAssert(object):
@@ -102,3 +111,324 @@ class TestDeepAssert(object):
 
         with assert_raises_regexp(AssertionError, u"at /baz.2.aww, expected 'uwl', got 'owl'"):
             assert_deep_equal(d1, d2)
+
+    def test_deeply_nested(self):
+        def chain(depth, leaf):
+            node = leaf
+            for i in xrange(depth):
+                node = {'next': [node]}
+            return node
+
+        assert_deep_equal(chain(10000, 'end'), chain(10000, 'end'))
+        with assert_raises_regexp(AssertionError, r"at (/next\.0)(\.next\.0)+, expected 'end', got 'END'"):
+            assert_deep_equal(chain(10000, 'END'), chain(10000, 'end'))
+
+    def test_shared_subtree(self):
+        shared = {'foo': [1, 2, 3]}
+        assert_deep_equal({'a': shared, 'b': shared}, {'a': shared, 'b': shared})
+
+        actual_shared = {'foo': [1, 2, 3]}
+        expected_shared = {'foo': [1, 2, 4]}
+        with assert_raises_regexp(AssertionError, "at /(a|b).foo.2, expected 4, got 3"):
+            assert_deep_equal({'a': actual_shared, 'b': actual_shared},
+                              {'a': expected_shared, 'b': expected_shared})
+
+    def test_reference_cycle(self):
+        actual = {'name': 'foo'}
+        actual['self'] = actual
+        expected = {'name': 'foo'}
+        expected['self'] = expected
+        assert_deep_equal(actual, expected)
+
+        expected['name'] = 'bar'
+        with assert_raises_regexp(AssertionError, "at /name, expected 'bar', got 'foo'"):
+            assert_deep_equal(actual, expected)
+
+    def test_max_diffs(self):
+        actual = {'foo': [1, 2, 3], 'bar': {'baz': 'qux', 'extra': 1}}
+        expected = {'foo': [1, 0, 0], 'bar': {'baz': 'qix'}}
+
+        with assert_raises(AssertionError) as e:
+            assert_deep_equal(actual, expected, max_diffs=10)
+
+        assert_in("at /foo.1, expected 0, got 2", str(e.exception))
+        assert_in("at /foo.2, expected 0, got 3", str(e.exception))
+        assert_in("at /bar, actual got unexpected keys ['extra']", str(e.exception))
+        assert_in("at /bar.baz, expected 'qix', got 'qux'", str(e.exception))
+        assert_not_in("stopped after", str(e.exception))
+
+    def test_max_diffs_cap(self):
+        actual = range(100)
+        expected = range(100, 200)
+
+        with assert_raises(AssertionError) as e:
+            assert_deep_equal(actual, expected, max_diffs=3)
+
+        assert_in("at /0, expected 100, got 0\n"
+                  "at /1, expected 101, got 1\n"
+                  "at /2, expected 102, got 2\n"
+                  "stopped after 3 differences", str(e.exception))
+        assert_not_in("at /3,", str(e.exception))
+
+    def test_large_structure_message(self):
+        actual = {'items': [{'id': i, 'blob': 'x' * 1000} for i in xrange(1000)]}
+        expected = {'items': [{'id': i, 'blob': 'x' * 1000} for i in xrange(1000)]}
+        expected['items'][500]['id'] = 'five hundred'
+
+        with assert_raises(AssertionError) as e:
+            assert_deep_equal(actual, expected, max_message_size=2000)
+
+        message = str(e.exception)
+        assert_in("at /items.500.id, expected 'five hundred', got 500", message)
+        assert_in("'id': 'five hundred',", message)
+        assert_in("...499 items...", message)
+        assert_in("...498 items...", message)
+        assert_less(len(message), 2500)
+
+    def test_ignore_list_order(self):
+        actual = {'tags': ['a', 'b', 'c', 'b'], 'items': [{'id': 2, 'tags': [2, 1]}, {'id': 1}]}
+        expected = {'tags': ['b', 'c', 'b', 'a'], 'items': [{'id': 1}, {'id': 2, 'tags': [1, 2]}]}
+        assert_deep_equal(actual, expected, ignore_list_order=True)
+        with assert_raises(AssertionError):
+            assert_deep_equal(actual, expected)
+
+    def test_ignore_list_order_inequal(self):
+        actual = [1, 2, 2, {'id': 3}]
+        expected = [{'id': 3}, 2, 1, 4]
+
+        with assert_raises_regexp(AssertionError, r"at /, actual got unexpected items \[2\], "
+                                                  r"expected items \[4\] are absent in actual"):
+            assert_deep_equal(actual, expected, ignore_list_order=True)
+
+        with assert_raises_regexp(AssertionError, r"at /, expected items \[4\] are absent in actual"):
+            assert_deep_equal([1, 2], [2, 1, 4], ignore_list_order=True)
+
+    def test_ignore_list_order_with_extra_keys(self):
+        actual = [{'id': 1, 'extra': True}, {'id': 2, 'extra': False}]
+        expected = [{'id': 2}, {'id': 1}]
+        assert_deep_equal(actual, expected, ignore_list_order=True, ignore_extra_keys=True)
+
+        # the first actual item matches both expected ones
+        assert_deep_equal([{'a': 1, 'b': 2}, {'a': 1}], [{'a': 1}, {'a': 1, 'b': 2}],
+                          ignore_list_order=True, ignore_extra_keys=True)
+
+    def test_ignore_list_order_large(self):
+        actual = [{'id': i, 'extra': i, 'tags': [i, 'x']} for i in xrange(2000)]
+        expected = [{'id': i, 'tags': ['x', i]} for i in reversed(xrange(2000))]
+        assert_deep_equal(actual, expected, ignore_list_order=True, ignore_extra_keys=True)
+
+        expected[0] = {'id': 'missing'}
+        with assert_raises_regexp(AssertionError, r"at /, actual got unexpected items \[\{.*'id': 1999.*\}\], "
+                                                  r"expected items \[\{'id': 'missing'\}\] are absent"):
+            assert_deep_equal(actual, expected, ignore_list_order=True, ignore_extra_keys=True)
+
+    def test_max_matching(self):
+        # every item but the last one prefers the candidate of the next item,
+        # so the last one is matched by a path through all of them
+        size = 5000
+        candidates = [[i + 1, i] for i in xrange(size - 1)] + [[size - 1]]
+        owners = _max_matching(candidates, lambda item, candidate: True)
+        assert_equal(owners, dict((i, i) for i in xrange(size)))
+
+        owners = _max_matching([[0, 1], [0], [0]], lambda item, candidate: True)
+        assert_equal(len(owners), 2)
+        assert_equal(owners[0] in (1, 2), True)
+
+    def test_ignore_list_order_expectations(self):
+        is_int = Expectation(lambda x: assert_equal(type(x), int))
+        assert_deep_equal([5], [is_int], ignore_list_order=True)
+        assert_deep_equal([{'a': 'x'}, {'a': 5}], [{'a': is_int}, {'a': 'x'}], ignore_list_order=True)
+        with assert_raises(AssertionError):
+            assert_deep_equal([{'a': 'x'}], [{'a': is_int}], ignore_list_order=True)
+
+    def test_fingerprint(self):
+        def make():
+            return {'foo': [{'id': i, 'name': u'item %s' % i} for i in xrange(10)], 'bar': (1, 2.5, None)}
+
+        expected = Fingerprint(make())
+        assert_deep_equal(make(), expected)
+
+        actual = make()
+        actual['foo'][7]['name'] = u'item 8'
+        with assert_raises_regexp(AssertionError, "at /foo.7.name, expected u'item 7', got u'item 8'"):
+            assert_deep_equal(actual, expected)
+
+    def test_fingerprint_unhashable_leaves(self):
+        expected = Fingerprint({'foo': [1, Expectation(assert_equal, 2)]})
+        assert_deep_equal({'foo': [1, 2]}, expected)
+        with assert_raises_regexp(AssertionError, "at /foo.1, expected <Failed expectation"):
+            assert_deep_equal({'foo': [1, 3]}, expected)
+
+    def test_fingerprint_nan(self):
+        with assert_raises(AssertionError):
+            assert_deep_equal([float('nan')], Fingerprint([float('nan')]))
+
+    def test_compile(self):
+        expected = {'foo': [{'id': 1, 'tags': ('a', 'b')}, {'id': 2, 'tags': ()}], 'bar': None}
+        check = compile_expected(expected)
+
+        check({'foo': [{'id': 1, 'tags': ('a', 'b')}, {'id': 2, 'tags': ()}], 'bar': None})
+        with assert_raises_regexp(AssertionError, "at /foo.1.id, expected 2, got 3"):
+            check({'foo': [{'id': 1, 'tags': ('a', 'b')}, {'id': 3, 'tags': ()}], 'bar': None})
+        with assert_raises_regexp(AssertionError, r"at /, actual got unexpected keys \['baz'\]"):
+            check({'foo': [{'id': 1, 'tags': ('a', 'b')}, {'id': 2, 'tags': ()}], 'bar': None, 'baz': 1})
+        with assert_raises_regexp(AssertionError, "^custom$"):
+            check({'foo': []}, msg='custom')
+
+    def test_compile_options(self):
+        check = compile_expected({'foo': [1, 2], 'bar': {'baz': 1}},
+                                 ignore_extra_keys=True, ignore_list_order=True)
+        check({'foo': [2, 1], 'bar': {'baz': 1, 'qux': 2}, 'extra': 3})
+        with assert_raises_regexp(AssertionError, r"at /foo, actual got unexpected items \[3\]"):
+            check({'foo': [2, 3], 'bar': {'baz': 1}})
+
+    def test_compile_unknown_options(self):
+        with assert_raises_regexp(TypeError, "unexpected keyword argument 'ignore_extra_key'"):
+            compile_expected({'foo': 1}, ignore_extra_key=True)
+        with assert_raises_regexp(TypeError, "unexpected keyword argument 'msg'"):
+            compile_expected({'foo': 1}, msg='custom')
+
+    def test_compile_iterable(self):
+        def items():
+            yield 1
+            yield 2
+
+        check = compile_expected({'a': [1, 2], 'b': 1}, ignore_list_order=True)
+        check({'a': items(), 'b': 1})
+        with assert_raises_regexp(AssertionError, "at /b, expected 1, got 2"):
+            check({'a': items(), 'b': 2})
+
+    def test_compile_shared_subtree(self):
+        shared = [1, 2]
+        check = compile_expected({'a': shared, 'b': shared, 'c': Expectation(assert_equal, 3)})
+        check({'a': [1, 2], 'b': [1, 2], 'c': 3})
+        with assert_raises_regexp(AssertionError, "at /b.1, expected 2, got 0"):
+            check({'a': [1, 2], 'b': [1, 0], 'c': 3})
+
+    def test_star_import_keeps_builtin_compile(self):
+        namespace = {}
+        exec 'from testmania.deep import *' in namespace
+        assert_in('assert_deep_equal', namespace)
+        assert_not_in('compile', namespace)
+
+    def test_buffers(self):
+        blob = 'x' * 100000 + 'abcdef' + 'y' * 100000
+        changed = 'x' * 100000 + 'abXdef' + 'y' * 100000
+        assert_deep_equal({'blob': bytearray(blob)}, {'blob': blob})
+        assert_deep_equal({'blob': memoryview(blob)}, {'blob': bytearray(blob)})
+
+        with assert_raises(AssertionError) as e:
+            assert_deep_equal({'blob': bytearray(changed)}, {'blob': blob})
+
+        message = str(e.exception)
+        assert_in("at /blob, buffers differ at offset 100002, "
+                  "expected ...7878787878786162[63]6465667979797979..., "
+                  "got ...7878787878786162[58]6465667979797979...", message)
+        assert_less(len(message), 3000)
+
+    def test_buffers_different_length(self):
+        with assert_raises_regexp(AssertionError, r"at /, buffers differ at offset 3, expected 616263\[64\], "
+                                                  r"got 616263\[end\] \(expected length is 4, actual length is 3\)"):
+            assert_deep_equal(bytearray('abc'), bytearray('abcd'))
+
+    def test_iterables(self):
+        def rows(n):
+            for i in xrange(n):
+                yield {'id': i}
+
+        assert_deep_equal({'rows': rows(3)}, {'rows': [{'id': 0}, {'id': 1}, {'id': 2}]})
+        assert_deep_equal(iter([1, 2]), (1, 2))
+        assert_deep_equal(rows(2), rows(2))
+        assert_deep_equal(xrange(3), [0, 1, 2])
+
+    def test_iterables_inequal(self):
+        consumed = []
+
+        def rows():
+            for i in xrange(1000000):
+                consumed.append(i)
+                yield {'id': i}
+
+        with assert_raises_regexp(AssertionError, "at /rows.3.id, expected 'three', got 3"):
+            assert_deep_equal({'rows': rows()}, {'rows': [{'id': 0}, {'id': 1}, {'id': 2}, {'id': 'three'}]})
+        assert_equal(consumed, [0, 1, 2, 3])
+
+    def test_iterables_different_length(self):
+        with assert_raises_regexp(AssertionError, "at /2, expected 3, actual has no more items"):
+            assert_deep_equal(iter([1, 2]), [1, 2, 3])
+        with assert_raises_regexp(AssertionError, "at /2, expected no more items, got 3"):
+            assert_deep_equal([1, 2, 3], iter([1, 2]))
+
+    def test_iterables_with_equality(self):
+        class Value(object):
+            def __iter__(self):
+                return iter([1])
+
+            def __eq__(self, other):
+                return isinstance(other, Value)
+
+            def __ne__(self, other):
+                return not self == other
+
+        assert_deep_equal(Value(), Value())
+        with assert_raises(AssertionError):
+            assert_deep_equal(Value(), [1])
+        with assert_raises(AssertionError):
+            assert_deep_equal(collections.deque([1, 2]), [1, 2])
+
+    def test_sets(self):
+        assert_deep_equal({'ids': set([1, 2, 3])}, {'ids': frozenset([3, 2, 1])})
+
+        with assert_raises_regexp(AssertionError, r"at /ids, actual got unexpected members \[4\], "
+                                                  r"expected members \[3\] are absent in actual"):
+            assert_deep_equal({'ids': set([1, 2, 4])}, {'ids': set([1, 2, 3])})
+
+    def test_large_sets(self):
+        actual = set(xrange(100000))
+        expected = set(xrange(50, 100050))
+
+        with assert_raises(AssertionError) as e:
+            assert_deep_equal(actual, expected)
+
+        message = str(e.exception)
+        assert_in("actual got unexpected members [", message)
+        assert_in("] and 40 more, expected members [", message)
+        assert_less(len(message), 5000)
+
+
+class TestDeepAssertNumpy(object):
+    def setup(self):
+        if numpy is None:
+            raise SkipTest("numpy is not installed")
+
+    def test_equal(self):
+        assert_deep_equal({'v': numpy.arange(6).reshape(2, 3)},
+                          {'v': numpy.arange(6).reshape(2, 3)})
+
+    def test_inequal_element(self):
+        actual = {'v': numpy.zeros((2, 3))}
+        expected = {'v': numpy.zeros((2, 3))}
+        expected['v'][1, 2] = 0.5
+
+        with assert_raises_regexp(AssertionError, "at /v.1.2, expected 0.5, got 0.0"):
+            assert_deep_equal(actual, expected)
+
+    def test_inequal_shape_and_dtype(self):
+        with assert_raises_regexp(AssertionError, r"at /, expected array of shape \(3,\), actual shape is \(2,\)"):
+            assert_deep_equal(numpy.zeros(2), numpy.zeros(3))
+        with assert_raises_regexp(AssertionError, "at /, expected array of dtype float64, actual dtype is int"):
+            assert_deep_equal(numpy.zeros(3, dtype=int), numpy.zeros(3))
+
+    def test_tolerance(self):
+        actual = [numpy.array([1.0, 2.0, 3.0001])]
+        expected = [numpy.array([1.0, 2.0, 3.0])]
+
+        assert_deep_equal(actual, expected, atol=0.001)
+        assert_deep_equal(actual, expected, rtol=0.001)
+        with assert_raises_regexp(AssertionError, r"at /0.2, expected 3.0, got 3.0001 \(rtol=0, atol=1e-05\)"):
+            assert_deep_equal(actual, expected, atol=0.00001)
+
+    def test_fingerprint_nan(self):
+        with assert_raises(AssertionError):
+            assert_deep_equal({'v': numpy.array([1.0, numpy.nan])},
+                              Fingerprint({'v': numpy.array([1.0, numpy.nan])}))
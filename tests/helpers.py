@@ -0,0 +1,12 @@
+# -*- coding: utf-8; -*-
+
+from StringIO import StringIO
+
+
+class TrickleFile(object):
+    """File that returns just one byte per read"""
+    def __init__(self, data):
+        self.data = StringIO(data)
+
+    def read(self, size=-1):
+        return self.data.read(1)
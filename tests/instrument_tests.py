@@ -0,0 +1,91 @@
+# -*- coding: utf-8; -*-
+
+import datetime
+import inspect
+from StringIO import StringIO
+
+from testmania import instrument
+from testmania.pep8 import assert_equal, assert_not_equal, assert_in, assert_raises, assert_true
+from testmania.deep import assert_deep_equal
+from testmania.expect import Expectation
+from testmania.json import assert_json_equal
+from testmania.time import assert_just_now
+from testmania.xml import assert_xml_equal
+
+
+class TestInstrument(object):
+    def setup(self):
+        instrument.reset()
+        instrument.enable()
+
+    def teardown(self):
+        instrument.disable()
+        instrument.reset()
+
+    def stats(self, name):
+        return [s for s in instrument.stats() if s.name == name]
+
+    def test_disabled(self):
+        instrument.disable()
+        assert_deep_equal([1, 2], [1, 2])
+        assert_equal(instrument.stats(), [])
+
+    def test_deep(self):
+        for i in xrange(3):
+            assert_deep_equal({'foo': [1, 2]}, {'foo': [1, 2]})
+        with assert_raises(AssertionError) as e:
+            assert_deep_equal({'foo': [1, 2]}, {'foo': [1, 3]})
+
+        failed, passed = sorted(self.stats('assert_deep_equal'), key=lambda s: s.count)
+        assert_equal(passed.count, 3)
+        assert_equal(passed.nodes, 3 * 4)
+        assert_equal(passed.message_bytes, 0)
+        assert_equal(failed.count, 1)
+        assert_equal(failed.message_bytes, len(str(e.exception)))
+        assert_in('instrument_tests.py:', failed.site)
+        assert_not_equal(failed.site, passed.site)
+        assert_true(passed.time > 0)
+
+    def test_nested(self):
+        assert_deep_equal({'at': datetime.datetime.now()}, {'at': Expectation(assert_just_now)})
+
+        [outer] = self.stats('assert_deep_equal')
+        [expectation] = self.stats('Expectation.__eq__')
+        [inner] = self.stats('assert_just_now')
+        # nested calls are attributed to the line of the test
+        assert_equal(expectation.site, outer.site)
+        assert_equal(inner.site, outer.site)
+        assert_equal(inner.count, 1)
+
+    def test_xml(self):
+        xml = '<a><b>1</b><c/></a>'
+        for i in xrange(2):
+            assert_xml_equal(xml, xml)
+
+        [stats] = self.stats('assert_xml_equal')
+        assert_equal(stats.count, 2)
+        # elements of both documents are hashed, then only of actual one
+        # since hash of expected one is cached
+        assert_equal(stats.nodes, 6 + 3)
+
+    def test_json(self):
+        assert_json_equal(StringIO('{"a": [1, 2]}'), StringIO('{"a": [1, 2]}'))
+
+        [stats] = self.stats('assert_json_equal')
+        assert_equal(stats.nodes, 4)
+
+    def test_signature(self):
+        args, varargs, varkw, defaults = inspect.getargspec(assert_deep_equal)
+        assert_equal(args[:3], ['actual', 'expected', 'msg'])
+        assert_equal((varargs, varkw), (None, None))
+        assert_equal(defaults[0], None)
+        assert_equal(assert_deep_equal.__name__, 'assert_deep_equal')
+        assert_equal(inspect.getargspec(Expectation.__eq__).args, ['self', 'other'])
+
+    def test_slowest(self):
+        assert_deep_equal(range(10000), range(10000))
+        assert_deep_equal([1], [1])
+
+        slowest = instrument.slowest(1)
+        assert_equal(len(slowest), 1)
+        assert_equal(slowest[0].nodes, 10001)
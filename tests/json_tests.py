@@ -0,0 +1,111 @@
+# -*- coding: utf-8; -*-
+
+import json
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from testmania.pep8 import assert_equal, assert_raises, assert_raises_regexp, assert_in
+from testmania.json import assert_json_equal
+from tests.helpers import TrickleFile
+
+
+def dump(obj):
+    return StringIO(json.dumps(obj))
+
+
+class TestJsonAssert(object):
+    def test_equal(self):
+        doc = {'foo': [1, 2.5, -3e10, True, False, None], 'bar': {'baz': u'qüx "\\'}}
+        assert_json_equal(dump(doc), dump(doc))
+
+    def test_primitive_inequal(self):
+        with assert_raises_regexp(AssertionError, "at /, expected 2, got 1"):
+            assert_json_equal(StringIO('1'), StringIO('2'))
+
+    def test_nested_inequal(self):
+        actual = {'foo': 1, 'bar': [{'baz': 'qux'}, {'bam': 'qix', 'tee': 'uup'}]}
+        expected = {'foo': 1, 'bar': [{'baz': 'qux'}, {'bam': 'qix', 'tee': 'uop'}]}
+
+        with assert_raises_regexp(AssertionError, "at /bar.1.tee, expected u'uop', got u'uup'"):
+            assert_json_equal(dump(actual), dump(expected))
+
+    def test_length_inequal(self):
+        with assert_raises_regexp(AssertionError, "at /foo, expected length is 5, actual length is 3"):
+            assert_json_equal(StringIO('{"foo": [1, 2, 3]}'),
+                              StringIO('{"foo": [1, 2, 3, [4, [5]], {"6": 6}]}'))
+
+    def test_type_inequal(self):
+        with assert_raises_regexp(AssertionError, r"at /foo, expected \[\.\.\.\], got \{\.\.\.\}"):
+            assert_json_equal(StringIO('{"foo": {}}'), StringIO('{"foo": []}'))
+
+    def test_key_order(self):
+        actual = StringIO('{"a": 1, "b": {"x": 1, "y": 2}, "c": 3}')
+        expected = StringIO('{"a": 1, "c": 3, "b": {"y": 2, "x": 1}}')
+        assert_json_equal(actual, expected)
+
+    def test_key_order_inequal(self):
+        actual = StringIO('{"a": 1, "b": {"x": 1, "y": 2}, "c": 3}')
+        expected = StringIO('{"a": 1, "c": 3, "b": {"y": 2, "x": 0}}')
+        with assert_raises_regexp(AssertionError, "at /b.x, expected 0, got 1"):
+            assert_json_equal(actual, expected)
+
+    def test_key_order_streams_actual(self):
+        # only the rest of expected object is loaded, actual is still read
+        # up to the first difference
+        actual = StringIO('{"b": [1, 2, 3, this is not json')
+        expected = StringIO('{"a": 0, "b": [1, 2, 4]}')
+        with assert_raises_regexp(AssertionError, "at /b.2, expected 4, got 3"):
+            assert_json_equal(actual, expected)
+
+    def test_key_order_nested(self):
+        assert_json_equal(StringIO('{"b": 1, "a": {"y": [1, {"z": 2, "w": null}], "x": 1}}'),
+                          StringIO('{"a": {"x": 1, "y": [1, {"w": null, "z": 2}]}, "b": 1}'))
+
+        with assert_raises_regexp(AssertionError, r"at /, expected keys \[u'a'\] are absent in actual"):
+            assert_json_equal(StringIO('{"b": 1}'), StringIO('{"a": 1, "b": 1}'))
+        with assert_raises_regexp(AssertionError, r"at /a, actual got unexpected keys \[u'y', u'z'\]"):
+            assert_json_equal(StringIO('{"b": 1, "a": {"y": 1, "x": 1, "z": 1}}'),
+                              StringIO('{"a": {"x": 1}, "b": 1}'))
+        assert_json_equal(StringIO('{"b": 1, "a": {"y": 1, "x": 1, "z": 1}}'),
+                          StringIO('{"a": {"x": 1}, "b": 1}'), ignore_extra_keys=True)
+        with assert_raises_regexp(AssertionError, "at /a, expected length is 2, actual length is 1"):
+            assert_json_equal(StringIO('{"b": 1, "a": [1]}'), StringIO('{"a": [1, 2], "b": 1}'))
+        with assert_raises_regexp(AssertionError, "at /a, expected length is 1, actual length is 3"):
+            assert_json_equal(StringIO('{"b": 1, "a": [1, [2], {}]}'), StringIO('{"a": [1], "b": 1}'))
+        with assert_raises_regexp(AssertionError, r"at /a.0, expected \{\.\.\.\}, got \[\.\.\.\]"):
+            assert_json_equal(StringIO('{"b": 1, "a": [[]]}'), StringIO('{"a": [{}], "b": 1}'))
+
+    def test_extra_keys(self):
+        with assert_raises_regexp(AssertionError, r"at /, actual got unexpected keys \[u'b'\]"):
+            assert_json_equal(StringIO('{"a": 1, "b": 2}'), StringIO('{"a": 1}'))
+        assert_json_equal(StringIO('{"a": 1, "b": 2}'), StringIO('{"a": 1}'),
+                          ignore_extra_keys=True)
+
+    def test_stops_at_first_difference(self):
+        actual = StringIO('[1, 2, 3, this is not json')
+        expected = StringIO('[1, 2, 4, neither is this')
+        with assert_raises_regexp(AssertionError, "at /2, expected 4, got 3"):
+            assert_json_equal(actual, expected)
+
+    def test_chunk_boundaries(self):
+        doc = {'foo': [12345, 6.75e-3, 'a long string with \\u0444 escapes', None, True]}
+        text = json.dumps(doc)
+        assert_json_equal(TrickleFile(text), TrickleFile(text))
+        with assert_raises_regexp(AssertionError, "at /foo.0, expected 12345, got 12346"):
+            assert_json_equal(TrickleFile(text.replace('12345', '12346')), TrickleFile(text))
+
+    def test_paths(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'doc.json')
+            with open(path, 'w') as f:
+                json.dump({'foo': [1, 2]}, f)
+            assert_json_equal(path, dump({'foo': [1, 2]}))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_invalid_json(self):
+        with assert_raises(ValueError):
+            assert_json_equal(StringIO('[1, 2'), StringIO('[1, 2'))
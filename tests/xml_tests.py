@@ -1,7 +1,17 @@
 # -*- coding: utf-8; -*-
 
-from testmania.pep8 import assert_equal, assert_raises, assert_raises_regexp, assert_in
-from testmania.xml import assert_xml_equal
+import os
+import shutil
+import tempfile
+import xml.etree.ElementTree as ElementTree
+from StringIO import StringIO
+from xml.parsers.expat import ExpatError
+
+import testmania.xml
+
+from testmania.pep8 import assert_equal, assert_raises, assert_raises_regexp, assert_in, assert_less
+from testmania.xml import assert_xml_equal, assert_xml_stream_equal, set_fixture_cache_size, Twinode
+from tests.helpers import TrickleFile
 
 
 class TestXmlAssert(object):
@@ -222,3 +232,379 @@ class TestXmlAssert(object):
         xml2 = '<root />'
 
         assert_xml_equal(xml1, xml2, ignore_extra_attrs=True)
+
+    def test_ignore_list_order_inequal(self):
+        xml1 = '<root><foo>1</foo><foo>2</foo><bar/></root>'
+        xml2 = '<root><foo>2</foo><foo>3</foo><bar/></root>'
+
+        with assert_raises(AssertionError) as e:
+            assert_xml_equal(xml1, xml2, ignore_list_order=True)
+
+        assert_in('at /root/foo expected "3", got "1"', str(e.exception))
+
+    def test_namespace_prefixes(self):
+        xml1 = '<s:root xmlns:s="urn:s"><s:foo>1</s:foo></s:root>'
+        xml2 = '<s:root xmlns:s="urn:s"><s:foo>2</s:foo></s:root>'
+
+        with assert_raises(AssertionError) as e:
+            assert_xml_equal(xml1, xml2)
+
+        assert_in('at /s:root/s:foo expected "2", got "1"', str(e.exception))
+
+    def test_comments_ignored(self):
+        assert_xml_equal('<root><!-- note --><foo/></root>', '<root><foo/></root>')
+
+    def test_unicode(self):
+        with assert_raises(AssertionError) as e:
+            assert_xml_equal(u'<root>Привет</root>', u'<root>Hello</root>')
+
+        assert_in('at /root expected "Hello", got "\xd0\x9f', str(e.exception))
+
+    def test_ignore_list_order_duplicates(self):
+        xml1 = '<root><foo/><foo/><foo>1</foo></root>'
+        xml2 = '<root><foo>1</foo><foo/><foo/><foo/></root>'
+
+        with assert_raises_regexp(AssertionError, "at /root expected <foo> element, got nothing"):
+            assert_xml_equal(xml1, xml2, ignore_list_order=True)
+
+    def test_ignore_list_order_nested(self):
+        xml1 = """
+        <root>
+            <item id="1"><tag>a</tag><tag>b</tag><name>x</name></item>
+            <item id="2"><tag>c</tag><name>y</name></item>
+            <note/>
+        </root>
+        """
+        xml2 = """
+        <root>
+            <note/>
+            <item id="2"><name>y</name><tag>c</tag></item>
+            <item id="1"><tag>b</tag><name>x</name><tag>a</tag></item>
+        </root>
+        """
+        assert_xml_equal(xml1, xml2, ignore_list_order=True, ignore_element_order=True)
+
+        with assert_raises(AssertionError):
+            assert_xml_equal(xml1, xml2, ignore_list_order=True)
+
+    def test_ignore_list_order_extra_attrs(self):
+        xml1 = '<root><foo a="1" b="2"/><foo a="2" b="1"/></root>'
+        xml2 = '<root><foo a="2"/><foo a="1"/></root>'
+        assert_xml_equal(xml1, xml2, ignore_list_order=True, ignore_extra_attrs=True)
+
+        with assert_raises_regexp(AssertionError, 'at /root/foo@a expected "3", got "1"'):
+            assert_xml_equal(xml1, '<root><foo a="2"/><foo a="3"/></root>',
+                             ignore_list_order=True, ignore_extra_attrs=True)
+
+    def test_ignore_list_order_large(self):
+        items = ['<item id="%s"><name>item %s</name></item>' % (i, i) for i in xrange(5000)]
+        xml1 = '<root>%s</root>' % ''.join(items)
+        xml2 = '<root>%s</root>' % ''.join(reversed(items))
+        assert_xml_equal(xml1, xml2, ignore_list_order=True)
+
+    def test_ignore_list_order_large_extras(self):
+        items = ['<item id="%s">item %s<name>%s</name></item>' % (i, i, i) for i in xrange(3000)]
+        expected = '<root>%s</root>' % ''.join(items)
+        actual = '<root>%s</root>' % ''.join(
+            item.replace('<item ', '<item x="1" ').replace('</item>', '<extra/></item>')
+            for item in reversed(items))
+        assert_xml_equal(actual, expected, ignore_list_order=True,
+                         ignore_extra_attrs=True, ignore_extra_elements=True)
+        with assert_raises(AssertionError):
+            assert_xml_equal(actual, expected, ignore_list_order=True, ignore_extra_attrs=True)
+        with assert_raises(AssertionError):
+            assert_xml_equal(actual, expected, ignore_list_order=True, ignore_extra_elements=True)
+
+    def test_ignore_list_order_ambiguous_extras(self):
+        # the first actual element matches both expected ones
+        assert_xml_equal('<r><a x="1" y="2" z="3"/><a x="1"/></r>', '<r><a x="1"/><a x="1" y="2"/></r>',
+                         ignore_list_order=True, ignore_extra_attrs=True)
+        assert_xml_equal('<r><a><b/><c/><d/></a><a><b/></a></r>', '<r><a><b/></a><a><b/><c/></a></r>',
+                         ignore_list_order=True, ignore_extra_elements=True)
+
+    def test_ignore_list_order_attr_and_text(self):
+        # an attribute t="foo" shouldn't look like a text "=foo" when matching
+        actual = ElementTree.fromstring('<root><r t="foo"/><r/></root>')
+        expected = ElementTree.fromstring('<root><r>=foo</r><r/></root>')
+        settings = testmania.xml._settings(False, False, True, False)
+        actual_rest, expected_rest = Twinode(actual, expected, settings).match_nodes(
+            list(actual), list(expected))
+        assert_equal(actual_rest, [actual[0]])
+        assert_equal(expected_rest, [expected[0]])
+
+        with assert_raises(AssertionError):
+            assert_xml_equal(actual, expected, ignore_list_order=True)
+
+    def test_message_built_once(self):
+        items = ''.join('<foo a="%s" b="x"/>' % i for i in xrange(20))
+        xml1 = '<root>%s</root>' % items
+        xml2 = '<root>%s<foo a="20"/></root>' % items.replace(' b="x"', '')
+        described = []
+        describe = Twinode.describe
+        Twinode.describe = lambda self, attr=None: described.append(attr) or describe(self, attr)
+        try:
+            with assert_raises_regexp(AssertionError, "at /root expected <foo> element, got nothing"):
+                assert_xml_equal(xml1, xml2, ignore_list_order=True, ignore_extra_attrs=True)
+        finally:
+            Twinode.describe = describe
+        assert_equal(described, [None])
+
+    def test_repeated_expected(self):
+        expected = '<root><foo a="1">Hello</foo><bar/></root>'
+        for i in xrange(2):
+            assert_xml_equal('<root>\n<foo a="1"> Hello </foo>\n<bar/></root>', expected)
+        assert_xml_equal('<root><foo a="1" b="2">Hello</foo><bar/></root>', expected,
+                         ignore_extra_attrs=True)
+
+        with assert_raises_regexp(AssertionError, 'at /root/foo expected "Hello", got "Privet"'):
+            assert_xml_equal('<root><foo a="1">Privet</foo><bar/></root>', expected)
+        with assert_raises(AssertionError):
+            assert_xml_equal('<root><bar/><foo a="1">Hello</foo></root>', expected)
+        assert_xml_equal('<root><bar/><foo a="1">Hello</foo></root>', expected,
+                         ignore_element_order=True)
+
+    def test_hash_of_attrs_and_texts(self):
+        with assert_raises_regexp(AssertionError, 'at /r@t expected nothing, got "foo"'):
+            assert_xml_equal('<r t="foo"/>', '<r>=foo</r>')
+        with assert_raises_regexp(AssertionError, 'at /r/a@tx expected nothing, got "1"'):
+            assert_xml_equal('<r><a tx="1"/></r>', '<r><a>x=1</a></r>')
+
+    def test_small_documents_printed(self):
+        with assert_raises(AssertionError) as e:
+            assert_xml_equal('<root><foo>1</foo></root>', '<root><foo>2</foo><bar a="x"/></root>')
+
+        assert_in('<root>\n\t<foo>\n\t\t2\n\t</foo>\n\t<bar a="x"/>\n</root>', str(e.exception))
+
+    def test_large_documents_windowed(self):
+        items = ''.join('<item id="%s"><name>item %s</name></item>' % (i, i) for i in xrange(10000))
+        expected = '<feed><items>%s</items><footer/></feed>' % items
+        actual = expected.replace('<name>item 5000</name>', '<name>item -1</name>')
+
+        with assert_raises(AssertionError) as e:
+            assert_xml_equal(actual, expected)
+
+        message = str(e.exception)
+        assert_in('at /feed/items/item/name expected "item 5000", got "item -1"', message)
+        assert_in('...4998 nodes...', message)
+        assert_in('<item id="5000">\n\t\t\t<name>\n\t\t\t\titem -1', message)
+        assert_in('...4997 nodes...\n\t</items>\n\t<footer/>\n</feed>', message)
+        assert_less(len(message), 4096)
+
+        with assert_raises(AssertionError) as e:
+            assert_xml_equal(actual, expected, max_message_size=10 ** 7)
+        assert_in('item 9999', str(e.exception))
+
+    def test_parsed_trees(self):
+        tree = ElementTree.ElementTree(ElementTree.fromstring('<root>\n  <foo a="1">Hello</foo>\n</root>'))
+        assert_xml_equal(tree, '<root><foo a="1">Hello</foo></root>')
+        assert_xml_equal('<root><foo a="1">Hello</foo></root>', tree.getroot())
+
+        with assert_raises_regexp(AssertionError, 'at /root expected "", got <foo> element'):
+            assert_xml_equal('<root><foo a="1">Hello</foo></root>', tree, ignore_whitespace=False)
+        # whitespace is skipped, not stripped
+        assert_equal(tree.getroot().text, '\n  ')
+
+    def test_parsed_trees_whitespace(self):
+        root = ElementTree.fromstring('<root>\n  <foo a="1">Hello</foo>\n  <bar>\n  </bar>\n</root>')
+        assert_xml_equal('<root><foo a="1">Hello</foo><bar/></root>', root)
+        assert_xml_equal(root, '<root><bar/><foo a="1">Hello</foo></root>', ignore_element_order=True)
+        with assert_raises(AssertionError) as e:
+            assert_xml_equal(root, '<root><foo a="1">Hi</foo><bar/></root>')
+        assert_in('Actual:\n<root>\n\t<foo a="1">\n\t\tHello\n\t</foo>\n\t<bar/>\n</root>\n',
+                  str(e.exception))
+        assert_equal(ElementTree.tostring(root),
+                     '<root>\n  <foo a="1">Hello</foo>\n  <bar>\n  </bar>\n</root>')
+
+    def test_parsed_trees_namespaces(self):
+        assert_xml_equal('<s:r xmlns:s="urn:s"/>', ElementTree.fromstring('<s:r xmlns:s="urn:s"/>'))
+        tree = ElementTree.fromstring('<r xmlns="urn:d" xmlns:x="urn:x" x:a="1"><x:b>Hello</x:b></r>')
+        assert_xml_equal(tree, '<d:r xmlns:d="urn:d" xmlns:y="urn:x" y:a="1"><y:b>Hello</y:b></d:r>')
+        with assert_raises_regexp(AssertionError, 'at / expected <{urn:s}r> element, got <{urn:t}r> element'):
+            assert_xml_equal('<s:r xmlns:s="urn:t"/>', ElementTree.fromstring('<s:r xmlns:s="urn:s"/>'))
+        # strings are compared as they are written
+        with assert_raises_regexp(AssertionError, 'at / expected <s:r> element, got <t:r> element'):
+            assert_xml_equal('<t:r xmlns:t="urn:s"/>', '<s:r xmlns:s="urn:s"/>')
+
+    def test_files_and_paths(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'doc.xml')
+            with open(path, 'w') as f:
+                f.write('<root><foo>Hello</foo></root>')
+            assert_xml_equal(StringIO('<root><foo>Hello</foo></root>'), path)
+            assert_xml_equal(path, u'<root><foo>Hello</foo></root>')
+            with assert_raises_regexp(AssertionError, 'at /root/foo expected "Hello", got "Privet"'):
+                assert_xml_equal('\xef\xbb\xbf<root><foo>Privet</foo></root>', open(path))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_garbage_not_taken_as_path(self):
+        for garbage in ['', 'Internal Server Error', 'nul\0byte']:
+            with assert_raises(ExpatError):
+                assert_xml_equal(garbage, '<root/>')
+
+    def test_fixture_cache(self):
+        parsed = []
+        parse = testmania.xml._parse
+        testmania.xml._parse = lambda source, **kwargs: parsed.append(source) or parse(source, **kwargs)
+        try:
+            expected = '<root><foo>%s</foo></root>' % id(parsed)
+            for i in xrange(3):
+                assert_xml_equal(expected, StringIO(expected))
+            with assert_raises(AssertionError):
+                assert_xml_equal('<root/>', expected)
+        finally:
+            testmania.xml._parse = parse
+        assert_equal(len(parsed), 4 + 1)
+
+        set_fixture_cache_size(0)
+        try:
+            assert_xml_equal(expected, expected)
+        finally:
+            set_fixture_cache_size(16)
+
+    def test_probe_stops_at_difference(self):
+        actual = ElementTree.fromstring('<root>%s</root>' % ('<foo>1</foo>' * 1000))
+        expected = ElementTree.fromstring('<root>%s</root>' % ('<foo>2</foo>' * 1000))
+        settings = testmania.xml._settings(False, False, False, False)
+        twinode, attr = Twinode(actual, expected, settings).probe()
+        assert_equal(twinode.describe(attr), 'at /root/foo expected "2", got "1"')
+        # root, its first child and text of the child
+        assert_equal(settings.nodes, 3)
+
+    def test_long_text(self):
+        # expat passes lines of a text one by one and buffers them, a text
+        # longer than the buffer would come in pieces
+        text = '\n'.join(['word'] * 10000)
+        assert_xml_equal('<root>\n    %s\n<foo/></root>' % text, '<root>%s<foo/></root>' % text)
+        with assert_raises_regexp(AssertionError, 'at /root expected "word\nword'):
+            assert_xml_equal('<root>%s</root>' % text.replace('\n', '\n\n', 1),
+                             '<root>%s</root>' % text)
+
+    def test_deeply_nested(self):
+        depth = 5000
+        xml1 = '<a>' * depth + '1' + '</a>' * depth
+        xml2 = '<a>' * depth + '2' + '</a>' * depth
+        assert_xml_equal(xml1, xml1)
+        with assert_raises_regexp(AssertionError, 'expected "2", got "1"'):
+            assert_xml_equal(xml1, xml2)
+
+    def test_deeply_nested_unordered(self):
+        depth = 40
+        xml1 = '<r>%s</r>' % ''.join('<a>' * depth + str(i) + '</a>' * depth for i in xrange(2))
+        xml2 = xml1.replace('>1<', '>2<')
+        with assert_raises(AssertionError):
+            assert_xml_equal(xml1, xml2, ignore_list_order=True, ignore_extra_elements=True)
+
+    def test_parallel(self):
+        items = ['<item id="%s"><qty>%s</qty></item>' % (i, i) for i in xrange(3000)]
+        expected = '<root>%s</root>' % ''.join(items)
+        assert_xml_equal(expected, expected, processes=2)
+        assert_xml_equal(expected, expected, processes=2, split_level=2)
+
+        items[2500] = '<item id="2500"><qty>-1</qty></item>'
+        items[1500] = '<item id="1500"><qty>-1</qty></item>'
+        actual = '<root>%s</root>' % ''.join(items)
+        for split_level in (1, 2):
+            with assert_raises_regexp(AssertionError, 'at /root/item/qty expected "1500", got "-1"'):
+                assert_xml_equal(actual, expected, processes=2, split_level=split_level)
+
+        actual = '<root a="1">%s</root>' % ''.join(items)
+        with assert_raises_regexp(AssertionError, 'at /root@a expected nothing, got "1"'):
+            assert_xml_equal(actual, expected, processes=2)
+
+        # differences above the split level are reported in document order too
+        items[2000] = '<item id="-1"><qty>2000</qty></item>'
+        actual = '<root>%s</root>' % ''.join(items)
+        with assert_raises_regexp(AssertionError, 'at /root/item/qty expected "1500", got "-1"'):
+            assert_xml_equal(actual, expected, processes=2, split_level=2)
+        items[1000] = '<item id="-1"><qty>1000</qty></item>'
+        actual = '<root>%s</root>' % ''.join(items)
+        with assert_raises_regexp(AssertionError, 'at /root/item@id expected "1000", got "-1"'):
+            assert_xml_equal(actual, expected, processes=2, split_level=2)
+
+    def test_parallel_small(self):
+        xml1 = '<root><foo>1</foo><bar/></root>'
+        xml2 = '<root><foo>2</foo><bar/></root>'
+        assert_xml_equal(xml1, xml1, processes=2)
+        with assert_raises_regexp(AssertionError, 'at /root/foo expected "2", got "1"'):
+            assert_xml_equal(xml1, xml2, processes=2)
+        with assert_raises_regexp(AssertionError, "at /root expected nothing, got <baz> element"):
+            assert_xml_equal('<root><foo>1</foo><bar/><baz/></root>', '<root><foo>1</foo><bar/></root>',
+                             processes=2, split_level=2)
+
+
+class TestXmlStreamAssert(object):
+    def assert_same_failure(self, actual, expected, **options):
+        with assert_raises(AssertionError) as tree_error:
+            assert_xml_equal(actual, expected, **options)
+        with assert_raises(AssertionError) as stream_error:
+            assert_xml_stream_equal(StringIO(actual), StringIO(expected), **options)
+        assert_equal(str(stream_error.exception), str(tree_error.exception).splitlines()[-1])
+        return str(stream_error.exception)
+
+    def test_equal(self):
+        xml = '<root a="1"><foo>Hello <b>world</b>!</foo><bar/></root>'
+        assert_xml_stream_equal(StringIO(xml), StringIO(xml))
+
+    def test_whitespace(self):
+        xml1 = '<root>\n  <foo>\n    Hello\n  </foo>\n</root>'
+        xml2 = '<root><foo>Hello</foo></root>'
+        assert_xml_stream_equal(StringIO(xml1), StringIO(xml2))
+        self.assert_same_failure(xml1, xml2, ignore_whitespace=False)
+
+    def test_same_paths(self):
+        failures = [
+            ('<foo/>', '<bar/>'),
+            ('<root><foo/></root>', '<root><foo/><bar/></root>'),
+            ('<root><foo/><bar/></root>', '<root><foo/></root>'),
+            ('<root><foo>Hello</foo></root>', '<root><foo>Privet</foo></root>'),
+            ('<root><foo>Hello</foo></root>', '<root><foo><bar/></foo></root>'),
+            ('<root foo="bar"/>', '<root foo="qux"/>'),
+            ('<root/>', '<root foo=""/>'),
+            ('<root><foo a="1"/></root>', '<root><foo/></root>'),
+        ]
+        for actual, expected in failures:
+            self.assert_same_failure(actual, expected)
+
+        message = self.assert_same_failure('<root><foo><bar>1</bar></foo></root>',
+                                           '<root><foo><bar>2</bar></foo></root>')
+        assert_equal(message, 'at /root/foo/bar expected "2", got "1"')
+
+    def test_extra_attrs(self):
+        xml1 = '<root foo="bar"><baz qux="1"/></root>'
+        xml2 = '<root><baz/></root>'
+        assert_xml_stream_equal(StringIO(xml1), StringIO(xml2), ignore_extra_attrs=True)
+
+    def test_stops_early(self):
+        head = '<root>' + '<item>1</item>' * 10
+        actual = StringIO(head + '<item>2</item>' + '<item>1</item>' * 100000 + '</root>')
+        expected = StringIO(head + '<item>3</item>' + '<item>1</item>' * 100000 + '</root>')
+
+        with assert_raises_regexp(AssertionError, 'at /root/item expected "3", got "2"'):
+            assert_xml_stream_equal(actual, expected)
+        assert_less(actual.tell(), len(actual.getvalue()))
+
+    def test_chunk_boundaries(self):
+        xml1 = u'<root a="é"><foo>Hello, мир</foo><bar/></root>'.encode('utf-8')
+        xml2 = u'<root a="é"><foo>Hello, мир</foo><baz/></root>'.encode('utf-8')
+        assert_xml_stream_equal(TrickleFile(xml1), StringIO(xml1))
+        with assert_raises_regexp(AssertionError, "at /root expected <baz> element, got <bar>"):
+            assert_xml_stream_equal(TrickleFile(xml1), TrickleFile(xml2))
+
+    def test_order_options(self):
+        xml1 = '<root><foo>1</foo><foo>2</foo><bar/></root>'
+        xml2 = '<root><bar/><foo>2</foo><foo>1</foo></root>'
+        assert_xml_stream_equal(StringIO(xml1), StringIO(xml2),
+                                ignore_element_order=True, ignore_list_order=True)
+        self.assert_same_failure(xml1, xml2, ignore_element_order=True)
+
+    def test_file_paths(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'doc.xml')
+            with open(path, 'w') as f:
+                f.write('<root><foo/></root>')
+            assert_xml_stream_equal(path, path)
+        finally:
+            shutil.rmtree(directory)